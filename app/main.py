@@ -1,15 +1,22 @@
+import collections
+import datetime
+import email.utils
 import json
+import mimetypes
 import os
 import re
 import time
+import unicodedata
+from urllib.parse import quote, urlencode
+from xml.sax.saxutils import escape
 
+import proxy
 import redis
 from starlette.applications import Starlette
 from starlette.config import Config
 from starlette.exceptions import HTTPException
-from starlette.middleware import Middleware
-from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from starlette.routing import Route
 from starlette.templating import Jinja2Templates
 
@@ -30,52 +37,701 @@ rq_redis = redis.Redis(
     port=config("REDIS_PORT", cast=int, default=6379),
     db=config("REDIS_DB_RQ", cast=int, default=11),
 )
-rq_queue = rq.Queue(name="default", connection=rq_redis)
-rq_retries = rq.Retry(max=3, interval=[10, 30, 120])
+DAV_PAGE_SIZE = 1000
+LISTING_BATCH = 1000
+LISTING_CHUNK = 64 * 1024
+LISTING_PAGE_SIZE = max(config("LISTING_PAGE_SIZE", cast=int, default=0), 0)
+METRICS_FLUSH_INTERVAL = 5
+HOME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+PROXY_FILES = config("PROXY_FILES", cast=bool, default=False)
+# same as the proxy location of nginx/nginx.vh.default.conf
+PROXY_FILE_PATH = re.compile(r"^(?P<media_type>[^/]+)/(?P<node>[^/]+)/(?P<media_path>.*\.\w+)$")
+SEARCH_LIMIT = 50
+SEARCH_MAX_LIMIT = 500
+SEARCH_FUZZY_MIN = 0.3
 
+# home() timings of this process, added to pr:metrics every few seconds like the worker metrics
+_home_timings = collections.Counter()
+_metrics_flushed = time.monotonic()
 
-class SetRqMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app):
-        super().__init__(app)
+# node folders live in generations, resolve the current one (or keep the one a listing started with) and
+# read a page of the folder: its children from the one after the cursor, their size & mtime, the generation
+# they belong to and whether more follow, in a single round trip
+list_generation_dir = r.register_script(
+    """
+    local location, node_location, after, count, pinned = ARGV[1], ARGV[2], ARGV[3], tonumber(ARGV[4]), ARGV[5]
+    local rkey_dir, gen, published
 
-    async def dispatch(self, request, call_next):
-        rq_queue.enqueue("tasks.get_plex_servers", job_id="get_plex_servers", retry=rq_retries)
+    if node_location == "" then
+        local latest = redis.call("HMGET", KEYS[1], "gen", "published")
+        rkey_dir, gen, published = "pr:dirs:" .. location, latest[1] or "0", latest[2] or "0"
+    else
+        gen = pinned
+        if gen == "" then
+            gen = redis.call("GET", KEYS[1])
+        end
+        if not gen then
+            return {{}, {}, "0", "0", 0}
+        end
+        rkey_dir, published = "pr:g:" .. gen .. ":dirs:" .. location, redis.call("GET", "pr:g:" .. gen .. ":published")
+        published = published or "0"
+    end
 
-        response = await call_next(request)
-        return response
+    -- the cursor is the last name of the previous page, when it's gone (another generation) the page starts
+    -- where it would have been, children are scored in this same order (see get_sort_key in the worker)
+    local start, total = 0, redis.call("ZCARD", rkey_dir)
+    if after ~= "" then
+        start = redis.call("ZRANK", rkey_dir, after)
+        if start then
+            start = start + 1
+        else
+            local sort_key = function(name)
+                return string.lower((string.gsub(name, "/$", "")))
+            end
+            local key, low, high = sort_key(after), 0, total
+            while low < high do
+                local middle = math.floor((low + high) / 2)
+                if sort_key(redis.call("ZRANGE", rkey_dir, middle, middle)[1]) <= key then
+                    low = middle + 1
+                else
+                    high = middle
+                end
+            end
+            start = low
+        end
+    end
+
+    local stop = -1
+    if count > 0 then
+        stop = start + count - 1
+    end
+    local children = redis.call("ZRANGE", rkey_dir, start, stop)
+    local more = 0
+    if start + #children < total then
+        more = 1
+    end
+
+    local prefix = ""
+    if node_location ~= "" and location ~= node_location then
+        prefix = string.sub(location, string.len(node_location) + 2) .. "/"
+    end
+
+    -- HMGET in batches, unpack() has a hard limit on the number of values
+    local metas = {}
+    for i = 1, #children, 1000 do
+        local fields = {}
+        for j = i, math.min(i + 999, #children) do
+            fields[#fields + 1] = prefix .. children[j]
+        end
+        if node_location == "" then
+            for _ = 1, #fields do
+                metas[#metas + 1] = ""
+            end
+        else
+            for _, meta in ipairs(redis.call("HMGET", "pr:g:" .. gen .. ":meta:" .. node_location, unpack(fields))) do
+                metas[#metas + 1] = meta or ""
+            end
+        end
+    end
+
+    return {children, metas, gen, published, more}
+    """
+)
+
+
+# titles of every listed node index (see _write_search_index in the worker): word prefixes first, through a
+# lex range of the word suffixes; when that's not enough, titles sharing enough trigrams with the query
+search_index = r.register_script(
+    """
+    local query, limit, fuzzy_min = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+    local trigrams = {}
+    for i = 4, #ARGV do
+        trigrams[#trigrams + 1] = ARGV[i]
+    end
+
+    local locations = {}
+    for _, media_type in ipairs(redis.call("ZRANGE", "pr:dirs:", 0, -1)) do
+        for _, node in ipairs(redis.call("ZRANGE", "pr:dirs:" .. string.sub(media_type, 1, -2), 0, -1)) do
+            local node_location = media_type .. string.sub(node, 1, -2)
+            local gen = redis.call("GET", "pr:gen:" .. node_location)
+            if gen then
+                locations[#locations + 1] = {node_location, "pr:g:" .. gen, {}}
+            end
+        end
+    end
+
+    -- {node location, "folder\ttitle\ttrigrams count", "size\tmtime", score} for every match
+    local results, count = {}, 0
+    local function add(location, ids, scores)
+        if #ids == 0 then
+            return
+        end
+        local titles = redis.call("HMGET", location[2] .. ":titles:" .. location[1], unpack(ids))
+        local folders = {}
+        for i, title in ipairs(titles) do
+            folders[i] = string.match(title or "", "^[^\t]*") .. "/"
+        end
+        local metas = redis.call("HMGET", location[2] .. ":meta:" .. location[1], unpack(folders))
+        for i, title in ipairs(titles) do
+            if title then
+                results[#results + 1] = {location[1], title, metas[i] or "", tostring(scores[i])}
+                count = count + 1
+            end
+        end
+    end
+
+    for _, location in ipairs(locations) do
+        local ids, scores, found = {}, {}, location[3]
+        local members = redis.call(
+            "ZRANGEBYLEX", location[2] .. ":search:" .. location[1], "[" .. query, "[" .. query .. "\255",
+            "LIMIT", 0, limit * 4
+        )
+        for _, member in ipairs(members) do
+            local id = string.sub(member, string.find(member, "\0", 1, true) + 1)
+            if not found[id] and #ids < limit then
+                found[id] = true
+                ids[#ids + 1] = id
+                scores[#scores + 1] = 1
+            end
+        end
+        add(location, ids, scores)
+    end
+
+    if count >= limit or #trigrams == 0 then
+        return results
+    end
+
+    -- similarity (jaccard) can't reach fuzzy_min below that many shared trigrams
+    local min_shared = math.max(math.ceil(#trigrams * fuzzy_min), 1)
+    for _, location in ipairs(locations) do
+        local shared = {}
+        for _, posting in ipairs(redis.call("HMGET", location[2] .. ":trigrams:" .. location[1], unpack(trigrams))) do
+            if posting then
+                for id in string.gmatch(posting, "%d+") do
+                    shared[id] = (shared[id] or 0) + 1
+                end
+            end
+        end
+
+        local candidates = {}
+        for id, n in pairs(shared) do
+            if n >= min_shared and not location[3][id] then
+                candidates[#candidates + 1] = {id, n}
+            end
+        end
+        table.sort(candidates, function(a, b) return a[2] > b[2] end)
+
+        local ids, shares = {}, {}
+        for i = 1, math.min(#candidates, limit * 2) do
+            ids[i], shares[i] = candidates[i][1], candidates[i][2]
+        end
+
+        if #ids > 0 then
+            local titles = redis.call("HMGET", location[2] .. ":titles:" .. location[1], unpack(ids))
+            local matches, scores = {}, {}
+            for i, title in ipairs(titles) do
+                local title_trigrams = tonumber(string.match(title or "", "(%d+)$") or "0")
+                local score = shares[i] / (#trigrams + title_trigrams - shares[i])
+                if title and score >= fuzzy_min then
+                    matches[#matches + 1] = ids[i]
+                    scores[#scores + 1] = score
+                end
+            end
+            add(location, matches, scores)
+        end
+    end
+
+    return results
+    """
+)
+
+
+def _is_not_modified(request: Request, etag: str, published: int) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+
+    try:
+        if_modified_since = email.utils.parsedate_to_datetime(request.headers.get("if-modified-since"))
+    except (TypeError, ValueError):
+        return False
+    return published <= if_modified_since.timestamp()
+
+
+def _parse_meta(meta: str = None) -> tuple:
+    # "size\tmtime" as stored in pr:g:<gen>:meta:<node>, empty for items without metadata
+    size, _, mtime = (meta or "").partition("\t")
+    return int(size) if size else None, int(mtime) if mtime and mtime != "0" else None
+
+
+def _format_size(size: int) -> str:
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if size < 1024 or unit == "TiB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def _add_texts(path: dict = None) -> dict:
+    # size & date as shown in index.html
+    path["size_text"] = _format_size(path["size"]) if path["size"] is not None else "-"
+    path["mtime_text"] = (
+        datetime.datetime.fromtimestamp(path["mtime"], datetime.timezone.utc).strftime("%Y-%m-%d %H:%M")
+        if path["mtime"]
+        else "-"
+    )
+    return path
+
+
+def _observe_home(depth: int = None, elapsed: float = None) -> None:
+    for bucket in (*HOME_BUCKETS, "+Inf"):
+        if bucket == "+Inf" or elapsed <= bucket:
+            _home_timings[f'pr_home_seconds_bucket{{depth="{depth}",le="{bucket}"}}'] += 1
+    _home_timings[f'pr_home_seconds_sum{{depth="{depth}"}}'] += elapsed
+    _home_timings[f'pr_home_seconds_count{{depth="{depth}"}}'] += 1
+    _flush_metrics()
+
+
+def _flush_metrics() -> None:
+    # home() timings & proxy counters of this process, added to pr:metrics every few seconds
+    global _metrics_flushed
+
+    if time.monotonic() - _metrics_flushed <= METRICS_FLUSH_INTERVAL:
+        return
+
+    _metrics_flushed = time.monotonic()
+    pipe = r.pipeline(transaction=False)
+    pipe.hset("pr:metrics:types", mapping={"pr_home_seconds": "histogram", **proxy.METRIC_TYPES})
+    for counter in (_home_timings, proxy.counters):
+        for series, value in counter.items():
+            pipe.hincrbyfloat("pr:metrics", series, value)
+        counter.clear()
+    pipe.execute()
 
 
 async def home(request):
-    context = {"request": request, "paths": []}
+    # files are proxied by nginx, unless PROXY_FILES hands them to the app (or there's no nginx in front)
+    if PROXY_FILES and (file := PROXY_FILE_PATH.match(request.path_params.get("path"))):
+        response = await proxy.stream_file(request, **file.groupdict())
+        _flush_metrics()
+        return response
+
+    started = time.perf_counter()
+    response = await _home(request)
     location = request.path_params.get("path").strip("/")
-    location_esc = ''.join([(c if re.match(r"[a-zA-Z0-9\.\\]", c) else ("\\" + c)) for c in location])
-    entries = list(r.scan_iter(f"pr:files:{location_esc}*"))
+    _observe_home(depth=location.count("/") + 1 if location else 0, elapsed=time.perf_counter() - started)
+    return response
+
+
+def _list_dir(location: str = None, after: str = "", count: int = 0, gen: str = "") -> tuple:
+    # one page of a folder: children, metas, generation, published, more
+    location_chunks = location.split("/") if location else []
+
+    if len(location_chunks) < 2:
+        return list_generation_dir(keys=["pr:gen:latest"], args=[location, "", after, count, ""])
+
+    node_location = "/".join(location_chunks[:2])
+    return list_generation_dir(keys=[f"pr:gen:{node_location}"], args=[location, node_location, after, count, gen])
+
+
+def _iter_dir(location: str = None, page: tuple = None, limit: int = 0, cursor: dict = None):
+    # (name, meta) of the folder in LISTING_BATCH pages, all from the generation of the first one; the
+    # name to continue from is left in cursor["next"] when the limit stops the listing early
+    children, metas, gen, _, more = page
+    sent = 0
+
+    while True:
+        yield from zip(children, metas)
+        sent += len(children)
+
+        if not more or not children:
+            return
+        if limit and sent >= limit:
+            cursor["next"] = children[-1]
+            return
+
+        count = min(LISTING_BATCH, limit - sent) if limit else LISTING_BATCH
+        children, metas, _, _, more = _list_dir(location, after=children[-1], count=count, gen=gen)
+
+
+def _buffered(chunks=None):
+    # the pieces of a streamed listing are sent LISTING_CHUNK at a time, not one thread hop each
+    buffer, size = [], 0
+
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= LISTING_CHUNK:
+            yield "".join(buffer)
+            buffer, size = [], 0
+
+    if buffer:
+        yield "".join(buffer)
+
+
+def _get_path(location: str = None, child: str = None, meta: str = None) -> dict:
+    size, mtime = _parse_meta(meta)
+    return {
+        "url": f"/{location}/{child}".replace("//", "/"),
+        "name": child,
+        "type": "dir" if child.endswith("/") else "file",
+        "size": size,
+        "mtime": mtime,
+    }
+
+
+async def _home(request):
+    location = request.path_params.get("path").strip("/")
+    after = request.query_params.get("after", "")
+    try:
+        limit = max(int(request.query_params.get("limit", LISTING_PAGE_SIZE)), 0)
+    except ValueError:
+        limit = LISTING_PAGE_SIZE
+
+    page = _list_dir(location, after=after, count=min(LISTING_BATCH, limit) if limit else LISTING_BATCH)
+    version, published = page[2], int(page[3])
+
+    as_json = request.query_params.get("format") == "json" or "application/json" in request.headers.get("accept", "")
+    etag = f'"{version}-json"' if as_json else f'"{version}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": email.utils.formatdate(published, usegmt=True),
+        "Cache-Control": "no-cache",
+        "Vary": "Accept",
+    }
+
+    # listings only change when a new generation is published
+    if _is_not_modified(request, etag, published):
+        return Response(status_code=304, headers=headers)
+    if request.method == "HEAD":
+        return Response(headers=headers, media_type="application/json" if as_json else "text/html")
+
+    # streamed as the pages are read, a folder of any size takes the same memory and starts right away
+    cursor = {"next": None}
+    paths = (_get_path(location, child, meta) for child, meta in _iter_dir(location, page, limit, cursor))
+
+    if as_json:
+
+        def listing():
+            yield f'{{"path": {json.dumps(f"/{location}")}, "version": {json.dumps(version)}, "paths": ['
+            for i, path in enumerate(paths):
+                yield f"{', ' if i else ''}{json.dumps(path)}"
+            yield f'], "next": {json.dumps(cursor["next"])}}}'
+
+        return StreamingResponse(_buffered(listing()), headers=headers, media_type="application/json")
+
+    def next_url():
+        # read by the template once all the paths are out
+        if cursor["next"]:
+            return f"/{location}/?".replace("//", "/") + urlencode({"after": cursor["next"], "limit": limit})
+
+    context = {"request": request, "paths": (_add_texts(path) for path in paths), "next_url": next_url}
+    return StreamingResponse(
+        _buffered(templates.get_template("index.html").generate(context)), headers=headers, media_type="text/html"
+    )
 
-    paths = {}
-    for entry in entries:
-        entry = entry.replace(f"pr:files:{location}", "").strip("/")
-        entry_chunks = entry.split("/")
 
-        paths[entry_chunks[0]] = {
-            "url": (f"/{location}/{entry_chunks[0]}" + ("/" if len(entry_chunks) > 1 else "")).replace("//", "/"),
-            "name": entry_chunks[0] + ("/" if len(entry_chunks) > 1 else ""),
-        }
+def _dav_response(path: str = None, size: int = None, mtime: int = None) -> str:
+    name = path.rstrip("/").rsplit("/", 1)[-1]
+    props = [f"<D:displayname>{escape(name)}</D:displayname>"]
 
-    paths = dict(sorted(paths.items(), key=lambda x: x[0].lower()))
-    context["paths"].extend(paths.values())
+    if path.endswith("/"):
+        props.append("<D:resourcetype><D:collection/></D:resourcetype>")
+    else:
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        props.append("<D:resourcetype/>")
+        props.append(f"<D:getcontenttype>{content_type}</D:getcontenttype>")
+        if size is not None:
+            props.append(f"<D:getcontentlength>{size}</D:getcontentlength>")
+    if mtime:
+        props.append(f"<D:getlastmodified>{email.utils.formatdate(mtime, usegmt=True)}</D:getlastmodified>")
 
-    return templates.TemplateResponse("index.html", context)
+    return (
+        f"<D:response><D:href>{escape(quote(path))}</D:href><D:propstat><D:prop>{''.join(props)}</D:prop>"
+        "<D:status>HTTP/1.1 200 OK</D:status></D:propstat></D:response>\n"
+    )
 
 
-async def startup(*args, **kwargs):
-    r.flushdb()
-    rq_queue.enqueue("tasks.get_plex_servers", job_id="get_plex_servers", retry=rq_retries)
+def _walk_generation(node_location: str = None, location: str = None):
+    # every file below location from the node's current generation (HSCAN, never the whole hash at once),
+    # folders are emitted the first time one of their files shows up
+    gen = r.get(f"pr:gen:{node_location}")
+    if not gen:
+        return
+
+    prefix = location[len(node_location) + 1 :]
+    prefix = f"{prefix}/" if prefix else ""
+    rkey_meta = f"pr:g:{gen}:meta:{node_location}"
+    seen = set()
+    cursor = None
+
+    while cursor != 0:
+        cursor, files = r.hscan(
+            f"pr:g:{gen}:files:{node_location}",
+            cursor=cursor or 0,
+            match=re.sub(r"([*?\[\]\\])", r"\\\1", prefix) + "*",
+            count=DAV_PAGE_SIZE,
+        )
+        paths = []
+
+        for file_path in files:
+            path_chunks = file_path.split("/")
+            for depth in range(prefix.count("/") + 1, len(path_chunks)):
+                dir_path = "/".join(path_chunks[:depth]) + "/"
+                if dir_path not in seen:
+                    seen.add(dir_path)
+                    paths.append(dir_path)
+            paths.append(file_path)
+
+        if not paths:
+            continue
+
+        for path, meta in zip(paths, r.hmget(rkey_meta, paths)):
+            yield f"/{node_location}/{path}", *_parse_meta(meta)
+
+
+def _walk_index(location: str = None, depth: str = None):
+    # (path, size, mtime) of everything below location, media types & nodes come from pr:dirs
+    location_chunks = location.split("/") if location else []
+
+    if len(location_chunks) >= 2:
+        node_location = "/".join(location_chunks[:2])
+
+        if depth == "infinity":
+            yield from _walk_generation(node_location=node_location, location=location)
+            return
+
+        for child, meta in _iter_dir(location, _list_dir(location, count=LISTING_BATCH)):
+            yield f"/{location}/{child}", *_parse_meta(meta)
+        return
+
+    for child in r.zrange(f"pr:dirs:{location}", 0, -1):
+        child_location = f"{location}/{child}".strip("/")
+        yield f"/{child_location}/", None, None
+
+        if depth == "infinity":
+            yield from _walk_index(location=child_location, depth=depth)
+
+
+def _dav_stat(location: str = None) -> tuple:
+    # (path, size, mtime) of the location itself, None when it's not in the index
+    location_chunks = location.split("/") if location else []
+
+    if not location_chunks:
+        return "/", None, None
+    if len(location_chunks) == 1:
+        return (f"/{location}/", None, None) if r.zscore("pr:dirs:", f"{location}/") is not None else None
+
+    node_location = "/".join(location_chunks[:2])
+    gen = r.get(f"pr:gen:{node_location}")
+    if not gen:
+        return None
+    if len(location_chunks) == 2:
+        return f"/{location}/", None, int(r.get(f"pr:g:{gen}:published") or 0) or None
+
+    media_path = location[len(node_location) + 1 :]
+    pipe = r.pipeline(transaction=False)
+    pipe.exists(f"pr:g:{gen}:dirs:{location}")
+    pipe.hexists(f"pr:g:{gen}:files:{node_location}", media_path)
+    pipe.hmget(f"pr:g:{gen}:meta:{node_location}", f"{media_path}/", media_path)
+    is_dir, is_file, (dir_meta, file_meta) = pipe.execute()
+
+    if is_dir:
+        return f"/{location}/", *_parse_meta(dir_meta)
+    if is_file:
+        return f"/{location}", *_parse_meta(file_meta)
+    return None
+
+
+async def propfind(request):
+    # read-only WebDAV view of the index, the files themselves are still served by the nginx proxy;
+    # the request body is ignored, every response carries the same (all) properties
+    location = request.path_params.get("path").strip("/")
+    depth = request.headers.get("depth", "infinity").lower()
+
+    if depth not in ("0", "1", "infinity"):
+        return Response(status_code=400)
+
+    stat = _dav_stat(location)
+    if not stat:
+        return Response(status_code=404)
+
+    def multistatus():
+        yield '<?xml version="1.0" encoding="utf-8"?>\n<D:multistatus xmlns:D="DAV:">\n'
+        yield _dav_response(*stat)
+
+        if depth != "0" and stat[0].endswith("/"):
+            for child in _walk_index(location=location, depth=depth):
+                yield _dav_response(*child)
+
+        yield "</D:multistatus>\n"
+
+    return StreamingResponse(multistatus(), status_code=207, media_type='application/xml; charset="utf-8"')
+
+
+async def dav_options(request):
+    return Response(headers={"DAV": "1", "Allow": "GET, HEAD, OPTIONS, PROPFIND", "MS-Author-Via": "DAV"})
+
+
+def _normalize_title(title: str = None) -> str:
+    # same as normalize_title in the worker, queries have to look like the indexed titles
+    title = unicodedata.normalize("NFKD", title.lower())
+    title = "".join(c for c in title if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[\W_]+", " ", title).split())
+
+
+async def search(request):
+    query = _normalize_title(request.query_params.get("q", ""))
+    try:
+        limit = min(max(int(request.query_params.get("limit", SEARCH_LIMIT)), 1), SEARCH_MAX_LIMIT)
+    except ValueError:
+        limit = SEARCH_LIMIT
+
+    results = []
+    if query:
+        padded = f" {query} "
+        trigrams = sorted({padded[i : i + 3] for i in range(len(padded) - 2)})
+        for node_location, title, meta, score in search_index(args=[query, limit, SEARCH_FUZZY_MIN, *trigrams]):
+            folder, title, _ = title.split("\t")
+            size, mtime = _parse_meta(meta)
+            results.append(
+                {
+                    "url": f"/{node_location}/{folder}/",
+                    "name": title,
+                    "location": node_location,
+                    "type": "dir",
+                    "size": size,
+                    "mtime": mtime,
+                    "score": round(float(score), 3),
+                }
+            )
+
+    # prefix matches (score 1) by title, then the closest fuzzy ones
+    results = sorted(results, key=lambda x: (-x["score"], x["name"].lower(), x["location"]))[:limit]
+
+    as_json = request.query_params.get("format") == "json" or "application/json" in request.headers.get("accept", "")
+    if as_json:
+        return JSONResponse({"query": request.query_params.get("q", ""), "results": results})
+
+    for result in results:
+        result["name"] = f"{result['name']} - {result['location']}"
+        _add_texts(result)
+
+    return templates.TemplateResponse("index.html", {"request": request, "paths": results})
+
+
+def _get_index_sizes() -> dict:
+    # files currently published per node index, pr:gen:<media type>/<node> -> generation
+    pointers = [key for key in r.scan_iter(match="pr:gen:*/*", count=1000)]
+    pipe = r.pipeline(transaction=False)
+    for key in pointers:
+        pipe.get(key)
+    gens = pipe.execute()
+
+    for gen, key in zip(gens, pointers):
+        pipe.hlen(f"pr:g:{gen}:files:{key.removeprefix('pr:gen:')}")
+    return {key.removeprefix("pr:gen:"): files for key, gen, files in zip(pointers, gens, pipe.execute()) if gen}
+
+
+async def prometheus_metrics(request):
+    # counters & histograms added up by the workers and the app, plus gauges read at scrape time
+    types = r.hgetall("pr:metrics:types")
+    series = r.hgetall("pr:metrics")
+    lines = []
+
+    for name, metric_type in sorted(types.items()):
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines += [
+            f"{key} {value}"
+            for key, value in sorted(series.items())
+            if key.partition("{")[0] in (name, f"{name}_bucket", f"{name}_sum", f"{name}_count")
+        ]
+
+    lines.append("# TYPE pr_index_files gauge")
+    for node_location, files in sorted(_get_index_sizes().items()):
+        media_type, _, node = node_location.partition("/")
+        lines.append(f'pr_index_files{{media_type="{media_type}",node="{node}"}} {files}')
+
+    lines.append("# TYPE pr_queue_jobs gauge")
+    for queue in sorted(rq.Queue.all(connection=rq_redis), key=lambda queue: queue.name):
+        lines.append(f'pr_queue_jobs{{queue="{queue.name}"}} {queue.count}')
+
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+def _get_task_profiles() -> list:
+    # pr_task_* counters of the workers (TASK_PROFILING) summed per task, the most time consuming first
+    tasks = {}
+
+    for key, value in r.hgetall("pr:metrics").items():
+        name, _, labels = key.partition("{")
+        if not name.startswith("pr_task_"):
+            continue
+
+        labels = dict(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', labels))
+        task = tasks.setdefault(
+            labels["task"], {"task": labels["task"], "jobs": 0, "seconds": 0, "phases": {}, "calls": {}}
+        )
+        if name == "pr_task_jobs_total":
+            task["jobs"] = int(float(value))
+        elif name == "pr_task_seconds_total":
+            task["seconds"] = float(value)
+        elif name == "pr_task_phase_seconds_total":
+            task["phases"][labels["phase"]] = float(value)
+        elif name == "pr_task_phase_calls_total":
+            task["calls"][labels["phase"]] = int(float(value))
+
+    return sorted(tasks.values(), key=lambda task: -task["seconds"])
+
+
+async def task_profiles(request):
+    # where the workers spend their time: tasks by cumulative time with the share of every phase, then the
+    # slowest jobs and their profile files (under PROFILE_PATH)
+    tasks = _get_task_profiles()
+    slowest = r.zrevrange("pr:profile:slowest", 0, -1)
+    jobs = [
+        {"id": job_id, **json.loads(job)}
+        for job_id, job in zip(slowest, r.hmget("pr:profile:jobs", slowest) if slowest else [])
+        if job
+    ]
+
+    as_json = request.query_params.get("format") == "json" or "application/json" in request.headers.get("accept", "")
+    if as_json:
+        return JSONResponse({"tasks": tasks, "slowest": jobs})
+
+    if not tasks:
+        return PlainTextResponse("no task profiles yet, TASK_PROFILING isn't enabled on the workers?\n")
+
+    phases = collections.Counter()
+    for task in tasks:
+        phases.update(task["phases"])
+    phases = [phase for phase, _ in phases.most_common()]
+    total = sum(task["seconds"] for task in tasks) or 1
+
+    lines = [
+        f"{'task':<28}{'jobs':>8}{'total s':>11}{'mean ms':>10}{'share':>7}" + "".join(f"{p:>10}" for p in phases)
+    ]
+    for task in tasks:
+        lines.append(
+            f"{task['task']:<28}{task['jobs']:>8}{task['seconds']:>11.1f}"
+            f"{task['seconds'] / max(task['jobs'], 1) * 1000:>10.1f}{task['seconds'] / total:>7.0%}"
+            + "".join(f"{task['phases'].get(p, 0) / (task['seconds'] or 1):>10.0%}" for p in phases)
+        )
+
+    lines += ["", f"{'slowest jobs':<28}{'seconds':>11}  {'slowest phase':<16}profile"]
+    for job in jobs:
+        phase = max(job["phases"].items(), key=lambda item: item[1])[0] if job["phases"] else "-"
+        lines.append(f"{job['task']:<28}{job['seconds']:>11.3f}  {phase:<16}{job['file'] or job['id']}")
+
+    return PlainTextResponse("\n".join(lines) + "\n")
 
 
 routes = [
-    Route("/{path:path}", home),
+    Route("/metrics", prometheus_metrics, methods=["GET"]),
+    Route("/profile", task_profiles, methods=["GET"]),
+    Route("/search", search, methods=["GET", "HEAD"]),
+    Route("/{path:path}", home, methods=["GET", "HEAD"]),
+    Route("/{path:path}", propfind, methods=["PROPFIND"]),
+    Route("/{path:path}", dav_options, methods=["OPTIONS"]),
 ]
 
-middleware = [Middleware(SetRqMiddleware)]
-
-app = Starlette(debug=True, routes=routes, middleware=middleware, on_startup=[startup])
+app = Starlette(debug=True, routes=routes, on_shutdown=[proxy.close])
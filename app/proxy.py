@@ -0,0 +1,252 @@
+import collections
+import time
+
+import httpx
+import redis
+from starlette.background import BackgroundTask
+from starlette.config import Config
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+
+config = Config()
+PROXY_POOL_SIZE = max(config("PROXY_POOL_SIZE", cast=int, default=16), 0)
+PLEX_CONNECT_TIMEOUT = config("PLEX_CONNECT_TIMEOUT", cast=float, default=5.0)
+PROXY_READ_TIMEOUT = 60
+PROXY_KEEPALIVE = 60
+PROXY_DOWN_TTL = 60
+PROXY_RESOLVE_TTL = 30
+PROXY_RESOLVE_MISS_TTL = 5
+PROXY_RESOLVE_MAX = 10000
+UPSTREAM_SCHEME = "https"
+# what a player/scanner sends that matters to the node, the rest (cookies, auth...) stays here
+FORWARDED_HEADERS = (
+    "accept",
+    "accept-encoding",
+    "if-match",
+    "if-modified-since",
+    "if-none-match",
+    "if-range",
+    "if-unmodified-since",
+    "range",
+    "user-agent",
+)
+HOP_BY_HOP_HEADERS = (
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+)
+METRIC_TYPES = {
+    "pr_proxy_requests_total": "counter",
+    "pr_proxy_connections_total": "counter",
+    "pr_proxy_failovers_total": "counter",
+}
+
+r = redis.Redis(
+    host=config("REDIS_HOST", default="redis"),
+    port=config("REDIS_PORT", cast=int, default=6379),
+    db=11,
+    decode_responses=True,
+)
+
+# same resolution as plex_resolve_script in nginx/nginx.vh.default.conf, one source per line:
+# "node\tip\tport\ttoken\tconnections\tlatency\tpart key"
+resolve_file = r.register_script(
+    """
+    local gen = redis.call("GET", "pr:gen:" .. ARGV[1])
+    if not gen then
+        return false
+    end
+
+    local value = redis.call("HGET", "pr:g:" .. gen .. ":files:" .. ARGV[1], ARGV[2])
+    if not value then
+        return false
+    end
+
+    local files = {}
+    if string.find(value, "\\t", 1, true) then
+        for node, plex_url in string.gmatch(value, "([^\\t\\n]+)\\t([^\\n]+)") do
+            files[#files + 1] = {node, plex_url}
+        end
+    else
+        files[1] = {ARGV[3], value}
+    end
+
+    local sources = {}
+    for _, file in ipairs(files) do
+        local node = redis.call("HMGET", "pr:node:" .. file[1], "ip", "port", "token", "connections", "latency")
+        if node[1] and node[2] and node[3] then
+            sources[#sources + 1] = table.concat({
+                file[1], node[1], node[2], node[3], node[4] or (node[1] .. ":" .. node[2]), node[5] or "", file[2]
+            }, "\\t")
+        end
+    end
+
+    if #sources == 0 then
+        return false
+    end
+    return table.concat(sources, "\\n")
+    """
+)
+
+# per process state, the nginx shared dicts of the openresty proxy: resolved files, connections & nodes that
+# just failed (tried last until then), requests in flight per node
+_resolved = {}
+_down = {}
+_load = collections.Counter()
+# keep-alive pools, one per plex node, reused by every request to it
+_clients = {}
+# added to pr:metrics by the app (see _flush_metrics)
+counters = collections.Counter()
+
+
+def _get_client(node: str = None) -> httpx.AsyncClient:
+    client = _clients.get(node)
+
+    if not client:
+        # certificates are issued for the plex.direct names, the nodes are reached by ip (as with nginx)
+        client = httpx.AsyncClient(
+            verify=False,
+            trust_env=False,
+            limits=httpx.Limits(
+                max_connections=None, max_keepalive_connections=PROXY_POOL_SIZE, keepalive_expiry=PROXY_KEEPALIVE
+            ),
+            timeout=httpx.Timeout(PROXY_READ_TIMEOUT, connect=PLEX_CONNECT_TIMEOUT),
+        )
+        _clients[node] = client
+
+    return client
+
+
+async def close() -> None:
+    for client in _clients.values():
+        await client.aclose()
+    _clients.clear()
+
+
+def _resolve(media_type: str = None, node: str = None, media_path: str = None) -> list:
+    # unknown files are cached shortly as well, scanners love to retry them
+    video_url = f"{media_type}/{node}/{media_path}"
+    now = time.monotonic()
+    expires, target = _resolved.get(video_url, (0, None))
+
+    if expires < now:
+        if len(_resolved) >= PROXY_RESOLVE_MAX:
+            _resolved.clear()
+        target = resolve_file(args=[f"{media_type}/{node}", media_path, node]) or ""
+        _resolved[video_url] = (now + (PROXY_RESOLVE_TTL if target else PROXY_RESOLVE_MISS_TTL), target)
+
+    sources = []
+    for line in target.split("\n") if target else []:
+        node, ip, port, token, connections, latency, url = line.split("\t", 6)
+        sources.append(
+            {
+                "node": node,
+                "token": token,
+                "connections": connections.split() or [f"{ip}:{port}"],
+                "latency": float(latency) if latency else None,
+                "url": url,
+            }
+        )
+    return sources
+
+
+def _is_down(key: str = None) -> bool:
+    return _down.get(key, 0) > time.monotonic()
+
+
+def _pick_source(sources: list = None) -> dict:
+    # fastest server weighed by the requests it's already serving, servers that just failed go last
+    def cost(source: dict) -> float:
+        return (source["latency"] or 250) * (1 + _load[source["node"]]) + (
+            1000000 if _is_down(f"node:{source['node']}") else 0
+        )
+
+    return min(sources, key=cost)
+
+
+def _rank_peers(connections: list = None) -> list:
+    # fastest first (as ranked by the worker probes), connections that failed recently go last
+    return sorted(connections, key=_is_down)
+
+
+async def _send(request, source: dict = None, headers: dict = None) -> httpx.Response:
+    # the connections of the node one after the other, the one that failed is marked down for the next requests
+    client = _get_client(source["node"])
+    peers = _rank_peers(source["connections"])
+
+    async def trace(event_name: str, info: dict) -> None:
+        if event_name == "connection.connect_tcp.complete":
+            counters[f'pr_proxy_connections_total{{node="{source["node"]}"}}'] += 1
+
+    for i, peer in enumerate(peers):
+        upstream_request = client.build_request(
+            request.method,
+            f"{UPSTREAM_SCHEME}://{peer}{source['url']}",
+            params={"X-Plex-Token": source["token"]},
+            headers={**headers, "Host": peer},
+            extensions={"trace": trace},
+        )
+        try:
+            return await client.send(upstream_request, stream=True)
+        except httpx.TransportError:
+            _down[peer] = time.monotonic() + PROXY_DOWN_TTL
+            if i == len(peers) - 1:
+                raise
+
+
+async def _release(upstream: httpx.Response = None, node: str = None) -> None:
+    _load[node] -= 1
+    await upstream.aclose()
+
+
+async def _stream(upstream: httpx.Response = None):
+    # the chunks as they come off the socket, each send waits for the client to take the previous one
+    # (uvicorn's flow control), so a slow player slows down the reads from the node too
+    try:
+        async for chunk in upstream.aiter_raw():
+            yield chunk
+    except httpx.TransportError:
+        # the node went away mid-file, the client gets a short body (same as with nginx)
+        return
+
+
+async def stream_file(request, media_type: str = None, node: str = None, media_path: str = None) -> Response:
+    # the openresty proxy location in python: GET/HEAD (ranges included) passed through to the fastest
+    # server of the file, the next one takes over when all the connections of a server fail
+    sources = _resolve(media_type=media_type, node=node, media_path=media_path)
+    if not sources:
+        return Response(status_code=404)
+
+    headers = {key: request.headers[key] for key in FORWARDED_HEADERS if key in request.headers}
+
+    while sources:
+        source = _pick_source(sources)
+        sources.remove(source)
+        _load[source["node"]] += 1
+
+        try:
+            upstream = await _send(request, source=source, headers=headers)
+        except httpx.TransportError:
+            _load[source["node"]] -= 1
+            _down[f"node:{source['node']}"] = time.monotonic() + PROXY_DOWN_TTL
+            counters[f'pr_proxy_failovers_total{{node="{source["node"]}"}}'] += 1
+            continue
+
+        counters[f'pr_proxy_requests_total{{node="{source["node"]}",status="{upstream.status_code}"}}'] += 1
+        response_headers = {
+            key: value for key, value in upstream.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS
+        }
+        background = BackgroundTask(_release, upstream=upstream, node=source["node"])
+
+        if request.method == "HEAD":
+            return Response(status_code=upstream.status_code, headers=response_headers, background=background)
+        return StreamingResponse(
+            _stream(upstream), status_code=upstream.status_code, headers=response_headers, background=background
+        )
+
+    # answered here, no other server left to try
+    return PlainTextResponse("no server of this file is reachable", status_code=502)
@@ -0,0 +1,260 @@
+"""
+End-to-end benchmark of the crawl -> index -> listing pipeline against bench/fake_plex.py,
+on fakeredis (default) or a local redis (db 11 is flushed!).
+
+    PYTHONPATH=rq python bench/crawl_pipeline.py --nodes 2 --movies 20000 --shows 500
+    PYTHONPATH=rq python bench/crawl_pipeline.py --redis 127.0.0.1:6379 --no-flat
+    PYTHONPATH=rq python bench/crawl_pipeline.py --no-flat --shows 300 --seasons 4 --rq-memory 100
+
+Jobs run one after another in this process, in the order the worker pool would pick them, delays
+(enqueue_in, rate limiting, process_media's settle time) are skipped so only the work itself is measured.
+"""
+
+import argparse
+import collections
+import os
+import re
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+from fake_plex import add_shape_arguments, from_arguments, serve
+
+
+def percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)] if values else 0
+
+
+def setup_redis(args: argparse.Namespace) -> None:
+    # everything (tasks, rq, app) connects through redis.Redis, point it at one shared server
+    os.environ["REDIS_DB_RQ"] = "11"
+    if args.redis:
+        host, _, port = args.redis.partition(":")
+        os.environ["REDIS_HOST"], os.environ["REDIS_PORT"] = host, port or "6379"
+        import redis
+
+        redis.Redis(host=host, port=int(port or 6379), db=11).flushdb()
+        return
+
+    import fakeredis
+    import redis
+
+    server = fakeredis.FakeServer()
+    redis.Redis = lambda *a, **kwargs: fakeredis.FakeRedis(
+        server=server, db=kwargs.get("db", 0), decode_responses=kwargs.get("decode_responses", False)
+    )
+
+
+def count_redis_calls(counters: collections.Counter) -> None:
+    # one round trip per command, one per pipeline/transaction
+    import redis.client
+
+    execute_command = redis.client.Redis.execute_command
+    pipeline_execute = redis.client.Pipeline.execute
+
+    def counted_execute_command(self, *args, **kwargs):
+        counters["redis"] += 1
+        return execute_command(self, *args, **kwargs)
+
+    def counted_pipeline_execute(self, *args, **kwargs):
+        counters["redis"] += 1
+        return pipeline_execute(self, *args, **kwargs)
+
+    redis.client.Redis.execute_command = counted_execute_command
+    redis.client.Pipeline.execute = counted_pipeline_execute
+
+
+def rq_memory(connection) -> int:
+    # bytes held by rq jobs & queues: MEMORY USAGE on a real redis, fakeredis has no such command so the
+    # stored field/entry bytes are summed instead (redis adds its per key/entry overhead on top of those)
+    import redis
+
+    total = 0
+    for pattern in ("rq:job:*", "rq:queue:*"):
+        for key in connection.scan_iter(pattern, count=1000):
+            try:
+                total += connection.memory_usage(key, samples=0) or 0
+            except redis.ResponseError:
+                kind = connection.type(key)
+                if kind == b"hash":
+                    total += sum(len(field) + len(value) for field, value in connection.hgetall(key).items())
+                elif kind == b"list":
+                    total += sum(map(len, connection.lrange(key, 0, -1)))
+    return total
+
+
+def drain(tasks_pool, worker, counters: collections.Counter, rq_memory_every: int = 0, rq_memory_peak: list = None):
+    # pool order: index > discovery > crawl queues > default, scheduled jobs are due right away
+    import rq
+    from rq.job import Job
+    from rq.registry import ScheduledJobRegistry
+
+    while True:
+        queues = [tasks_pool.index_queue, tasks_pool.discovery_queue, *tasks_pool._get_crawl_queues()]
+
+        for queue in queues:
+            registry = ScheduledJobRegistry(queue=queue)
+            for job_id in registry.get_job_ids():
+                job = Job.fetch(job_id, connection=queue.connection)
+                queue.enqueue_job(job, at_front=bool(job.enqueue_at_front))
+                registry.remove(job)
+
+        if rq_memory_every and counters["jobs run"] % rq_memory_every == 0:
+            # sampling is not part of the pipeline, keep it out of the round trips
+            redis_calls = counters["redis"]
+            rq_memory_peak[0] = max(rq_memory_peak[0], rq_memory(tasks_pool.index_queue.connection))
+            counters["redis"] = redis_calls
+
+        result = rq.Queue.dequeue_any(queues, None, connection=tasks_pool.index_queue.connection)
+        if not result:
+            return
+
+        job, queue = result
+        counters["jobs run"] += 1
+        counters[f"job {job.func_name.removeprefix('tasks.')}"] += 1
+        if not worker.perform_job(job, queue):
+            counters["jobs failed"] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_shape_arguments(parser)
+    parser.add_argument("--redis", default=None, help="host:port of a local redis instead of fakeredis")
+    parser.add_argument("--no-flat", action="store_true", help="crawl shows show -> season -> episode")
+    parser.add_argument("--samples", type=int, default=200, help="listing requests per directory depth")
+    parser.add_argument(
+        "--rq-memory", type=int, default=0, metavar="N", help="sample the memory of rq jobs & queues every N jobs"
+    )
+    args = parser.parse_args()
+
+    os.environ.update(
+        {
+            "FLAT_EPISODES": "false" if args.no_flat else "true",
+            "PLEX_RATE_LIMIT": "1000000",
+            "PLEX_RATE_BURST": "1000000",
+            "PLEX_TOKEN": "bench",
+        }
+    )
+    setup_redis(args)
+    counters = collections.Counter()
+    count_redis_calls(counters)
+
+    fake_plex = from_arguments(args)
+    server = serve(fake_plex)
+    fake_url = f"http://127.0.0.1:{server.server_port}"
+
+    import tasks
+    import tasks.plex_reshare as plex_reshare
+    import tasks.pool as tasks_pool
+
+    import rq
+
+    # https://<ip>.<node>.plex.direct:<port>/... -> fake server, plex.tv included
+    plex_get = plex_reshare.plex_get
+
+    def fake_plex_get(node: str = None, url: str = None, **kwargs):
+        url = re.sub(r"^https://[^.]+\.([^.]+)\.plex\.direct:\d+", rf"{fake_url}/_/\1", url)
+        url = re.sub(r"^https://clients\.plex\.tv", fake_url, url)
+        return plex_get(node=node, url=url, **kwargs)
+
+    plex_reshare.plex_get = fake_plex_get
+    plex_reshare.time.sleep = lambda seconds: None
+    pickledb_path = os.path.join(tempfile.mkdtemp(), "pr.db")
+    plex_reshare._get_pickledb = lambda autodump=True: plex_reshare.pickledb.load(pickledb_path, autodump)
+
+    process_media = tasks.process_media
+    process_media_timings = []
+
+    def timed_process_media(*a, **kwargs):
+        start = time.perf_counter()
+        process_media(*a, **kwargs)
+        process_media_timings.append(time.perf_counter() - start)
+
+    tasks.process_media = timed_process_media
+
+    create_job = rq.Queue.create_job
+
+    def counted_create_job(self, *a, **kwargs):
+        counters["jobs enqueued"] += 1
+        return create_job(self, *a, **kwargs)
+
+    rq.Queue.create_job = counted_create_job
+
+    worker = rq.SimpleWorker([tasks_pool.index_queue], connection=tasks_pool.index_queue.connection)
+    total_files = args.nodes * (
+        args.movie_libraries * args.movies + args.show_libraries * args.shows * args.seasons * args.episodes
+    )
+    print(f"{args.nodes} node(s), {total_files} files, flat episodes: {not args.no_flat}")
+
+    # crawl: discovery, then the libraries of every node the way the refresh scheduler queues them
+    rq_memory_peak = [0]
+    start = time.perf_counter()
+    tasks_pool.discovery_queue.enqueue("tasks.get_plex_servers")
+    drain(tasks_pool, worker, counters, args.rq_memory, rq_memory_peak)
+
+    for plex_server in plex_reshare.json.loads(plex_reshare.r.get("pr:servers")):
+        tasks_pool.crawl_queue(plex_server["node"]).enqueue(
+            "tasks.get_plex_libraries", kwargs={"plex_server": plex_server}
+        )
+    drain(tasks_pool, worker, counters, args.rq_memory, rq_memory_peak)
+    crawl_time = time.perf_counter() - start
+
+    crawl_redis = counters["redis"]
+    print(f"{'crawl wall time':<32}{crawl_time:>12.3f}s")
+    print(f"{'http requests':<32}{fake_plex.requests:>12}")
+    print(f"{'redis round trips':<32}{crawl_redis:>12}")
+    # linux reports kilobytes
+    print(f"{'peak rss':<32}{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:>11.1f}M")
+    try:
+        used_memory = plex_reshare.r.info("memory")["used_memory"]
+        print(f"{'redis used memory':<32}{used_memory / 1024 / 1024:>11.1f}M")
+    except Exception:
+        print(f"{'redis used memory':<32}{'n/a':>12}")
+    if args.rq_memory:
+        # finished jobs stay around for the worker's default_result_ttl, longer than this crawl
+        print(f"{'rq jobs & queues peak':<32}{rq_memory_peak[0] / 1024 / 1024:>11.1f}M")
+        rq_memory_left = rq_memory(tasks_pool.index_queue.connection)
+        print(f"{'rq jobs & queues after crawl':<32}{rq_memory_left / 1024 / 1024:>11.1f}M")
+    for name, count in sorted(counters.items()):
+        if name.startswith("job"):
+            print(f"{name:<32}{count:>12}")
+    if process_media_timings:
+        print(
+            f"{'process_media':<32}{sum(process_media_timings):>11.3f}s"
+            f"  ({len(process_media_timings)} runs, last {process_media_timings[-1]:.3f}s)"
+        )
+
+    # listings: walk the tree breadth first through the JSON variant, time every request per depth
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+    os.chdir(sys.path[0])
+    import main as app_main
+    from starlette.testclient import TestClient
+
+    client = TestClient(app_main.app)
+    latencies = collections.defaultdict(list)
+    level = ["/"]
+
+    for depth in range(6):
+        next_level = []
+        for url in level[: args.samples]:
+            start = time.perf_counter()
+            res = client.get(url, params={"format": "json"})
+            latencies[depth].append(time.perf_counter() - start)
+            next_level += [path["url"] for path in res.json()["paths"] if path["type"] == "dir"]
+        if not next_level:
+            break
+        level = next_level
+
+    for depth, values in latencies.items():
+        print(
+            f"{f'home() depth {depth}':<32}p50 {percentile(values, 50) * 1000:>8.2f}ms"
+            f"  p99 {percentile(values, 99) * 1000:>8.2f}ms  mean {statistics.mean(values) * 1000:>8.2f}ms"
+            f"  ({len(values)} requests)"
+        )
+
+
+if __name__ == "__main__":
+    main()
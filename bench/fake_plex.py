@@ -0,0 +1,355 @@
+"""
+Stand-in plex.tv + Plex Media Server for the benchmarks, serves synthetic libraries of any shape
+without keeping them in memory (items are generated from their index on every request).
+
+    python bench/fake_plex.py --port 32400 --nodes 2 --movies 100000 --shows 2000 --seasons 5 --episodes 100
+
+Every node answers under /_/<node>/..., bench/crawl_pipeline.py rewrites the https://<ip>.<node>.plex.direct
+urls the crawler builds to that prefix. Media parts are served as well (GET/HEAD, single ranges) with the
+sizes of the listings, for bench/proxy_stream.py.
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BASE_UPDATED_AT = 1_700_000_000
+
+
+class FakePlex:
+    def __init__(
+        self,
+        nodes: int = 1,
+        movie_libraries: int = 1,
+        movies: int = 1000,
+        show_libraries: int = 1,
+        shows: int = 50,
+        seasons: int = 3,
+        episodes: int = 10,
+        latency: float = 0,
+    ):
+        # counts are per library (movies, shows) / per show (seasons) / per season (episodes)
+        self.nodes = [f"{i:02d}fakenode{i:02d}" for i in range(nodes)]
+        self.movie_libraries = [str(i + 1) for i in range(movie_libraries)]
+        self.show_libraries = [str(movie_libraries + i + 1) for i in range(show_libraries)]
+        self.movies = movies
+        self.shows = shows
+        self.seasons = seasons
+        self.episodes = episodes
+        self.latency = latency
+        self.requests = 0
+        self.connections = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    # plex.tv
+    def resources(self) -> list:
+        return [
+            {
+                "provides": "server",
+                "clientIdentifier": node,
+                "accessToken": f"token-{node}",
+                "owned": False,
+                "connections": [
+                    {
+                        "uri": f"https://127-0-0-1.{node}.plex.direct:32400",
+                        "port": 32400,
+                        "relay": False,
+                        "local": False,
+                        "IPv6": False,
+                    }
+                ],
+            }
+            for node in self.nodes
+        ]
+
+    # plex media server
+    def sections(self) -> dict:
+        details = {"agent": "tv.plex.agents.movie", "scanner": "Plex Movie", "language": "en-US"}
+        directories = [
+            {**details, "key": key, "type": "movie", "title": f"Movies {key}", "Location": [{"path": "/data/movies"}]}
+            for key in self.movie_libraries
+        ]
+        directories += [
+            {**details, "key": key, "type": "show", "title": f"Shows {key}", "Location": [{"path": "/data/shows"}]}
+            for key in self.show_libraries
+        ]
+        return {"MediaContainer": {"size": len(directories), "Directory": directories}}
+
+    @staticmethod
+    def _media(item_id: str, path: str, size: int) -> list:
+        return [
+            {
+                "videoResolution": "1080",
+                "Part": [
+                    {"key": f"/library/parts/{item_id}/file.mkv", "file": path, "size": size, "container": "mkv"}
+                ],
+            }
+        ]
+
+    def movie(self, node: str, library: str, i: int) -> dict:
+        title, year = f"Movie {library}-{i}", 1950 + i % 75
+        return {
+            "type": "movie",
+            "title": title,
+            "year": year,
+            "updatedAt": BASE_UPDATED_AT + i,
+            "Media": self._media(
+                f"{library}{i}",
+                f"/data/{node}/movies/{title} ({year}) [imdb-{i}]/{title} ({year}) [WEBDL-1080p].mkv",
+                2_000_000_000 + i,
+            ),
+        }
+
+    @staticmethod
+    def _details(rating_key: str) -> dict:
+        # what plex sends along with every show/season, never used by the crawl but pickled into jobs handed it
+        return {
+            "ratingKey": rating_key,
+            "guid": f"plex://show/{rating_key:0>24}",
+            "summary": "A synthetic summary, about as long as the ones plex pulls from its metadata agents. " * 6,
+            "thumb": f"/library/metadata/{rating_key}/thumb/{BASE_UPDATED_AT}",
+            "art": f"/library/metadata/{rating_key}/art/{BASE_UPDATED_AT}",
+            "theme": f"/library/metadata/{rating_key}/theme/{BASE_UPDATED_AT}",
+            "contentRating": "TV-14",
+            "audienceRating": 8.1,
+            "addedAt": BASE_UPDATED_AT,
+            "updatedAt": BASE_UPDATED_AT,
+            "Genre": [{"tag": tag} for tag in ("Drama", "Crime", "Thriller")],
+            "Role": [
+                {
+                    "tag": f"Actor {role}",
+                    "role": f"Character {role}",
+                    "thumb": f"https://metadata-static.plex.tv/{role}",
+                }
+                for role in range(8)
+            ],
+        }
+
+    def show(self, library: str, i: int) -> dict:
+        return {
+            **self._details(f"s{library}-{i}"),
+            "type": "show",
+            "title": f"Show {library}-{i}",
+            "key": f"/library/metadata/s{library}-{i}/children",
+        }
+
+    def season(self, library: str, show: int, season: int) -> dict:
+        return {
+            **self._details(f"e{library}-{show}-{season}"),
+            "type": "season",
+            "index": season + 1,
+            "key": f"/library/metadata/e{library}-{show}-{season}/children",
+        }
+
+    def episode(self, node: str, library: str, i: int) -> dict:
+        show, show_episode = divmod(i, self.seasons * self.episodes)
+        season, episode = divmod(show_episode, self.episodes)
+        name = f"Show {library}-{show}"
+        return {
+            "type": "episode",
+            "updatedAt": BASE_UPDATED_AT + i,
+            "Media": self._media(
+                f"{library}{i}",
+                f"/data/{node}/shows/{name} [tvdb-{show}]/Season {season + 1:02}/"
+                f"{name} - S{season + 1:02}E{episode + 1:02} [WEBDL-1080p].mkv",
+                500_000_000 + i,
+            ),
+        }
+
+    @staticmethod
+    def _page(query: dict, total: int, item, updated_since: int = None) -> dict:
+        start = int(query.get("X-Plex-Container-Start", ["0"])[0])
+        size = int(query.get("X-Plex-Container-Size", ["100"])[0])
+
+        # updatedAt grows with the index, a delta starts right after the last known item
+        first = 0 if updated_since is None else max(0, updated_since - BASE_UPDATED_AT)
+        total = max(total - first, 0)
+        metadata = [item(first + i) for i in range(start, min(start + size, total))]
+
+        return {"MediaContainer": {"offset": start, "size": len(metadata), "totalSize": total, "Metadata": metadata}}
+
+    def library_all(self, node: str, library: str, query: dict) -> dict:
+        since = query.get("updatedAt>", [None])[0]
+        since = int(since) if since else None
+
+        if library in self.movie_libraries:
+            return self._page(query, self.movies, lambda i: self.movie(node, library, i), since)
+        if query.get("type", [""])[0] == "4":
+            total = self.shows * self.seasons * self.episodes
+            return self._page(query, total, lambda i: self.episode(node, library, i), since)
+        return self._page(query, self.shows, lambda i: self.show(library, i))
+
+    def metadata_children(self, node: str, metadata_id: str, query: dict) -> dict:
+        if metadata_id.startswith("s"):
+            library, show = metadata_id[1:].split("-")
+            return self._page(query, self.seasons, lambda i: self.season(library, int(show), i))
+
+        library, show, season = metadata_id[1:].split("-")
+        first = (int(show) * self.seasons + int(season)) * self.episodes
+        return self._page(query, self.episodes, lambda i: self.episode(node, library, first + i))
+
+    def part_size(self, path: str):
+        # /_/<node>/library/parts/<library><index>/file.mkv (single digit library keys), same sizes as listed
+        match = re.match(r"^/_/(?P<node>[^/]+)/library/parts/(?P<library>\d)(?P<i>\d+)/file\.mkv$", path)
+        if not match or match["node"] not in self.nodes:
+            return None
+        if match["library"] in self.movie_libraries:
+            return 2_000_000_000 + int(match["i"])
+        return 500_000_000 + int(match["i"])
+
+    def count(self, requests: int = 0, connections: int = 0, bytes_sent: int = 0) -> None:
+        with self._lock:
+            self.requests += requests
+            self.connections += connections
+            self.bytes_sent += bytes_sent
+
+    def handle(self, path: str, query: dict):
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        if path == "/api/v2/resources":
+            return self.resources()
+
+        match = re.match(r"^/_/(?P<node>[^/]+)(?P<path>/.*)$", path)
+        if not match or match["node"] not in self.nodes:
+            return None
+        node, path = match["node"], match["path"]
+
+        if path == "/library/sections":
+            return self.sections()
+        if section := re.match(r"^/library/sections/(?P<key>[^/]+)/all$", path):
+            return self.library_all(node, section["key"], query)
+        if children := re.match(r"^/library/metadata/(?P<id>[^/]+)/children$", path):
+            return self.metadata_children(node, children["id"], query)
+        return None
+
+
+def serve(fake_plex: FakePlex, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    # file contents: the same 1MiB block over and over, written straight from memory
+    block = memoryview(bytes(range(256)) * 4096)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            fake_plex.count(connections=1)
+
+        def send_part(self, size: int, head: bool = False):
+            # single "bytes=first-[last]" ranges, like players & scanners send
+            first, last = 0, size - 1
+            match = re.match(r"^bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+            if match:
+                first, last = int(match[1]), min(int(match[2] or size - 1), size - 1)
+
+            self.send_response(206 if match else 200)
+            self.send_header("Content-Type", "video/x-matroska")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(last - first + 1))
+            if match:
+                self.send_header("Content-Range", f"bytes {first}-{last}/{size}")
+            self.end_headers()
+
+            position = first
+            while not head and position <= last:
+                offset = position % len(block)
+                chunk = block[offset : offset + min(len(block) - offset, last - position + 1)]
+                try:
+                    self.wfile.write(chunk)
+                except ConnectionError:
+                    # the client stopped reading halfway, players do that all the time
+                    self.close_connection = True
+                    return
+                fake_plex.count(bytes_sent=len(chunk))
+                position += len(chunk)
+
+        def do_HEAD(self):
+            size = fake_plex.part_size(urlparse(self.path).path)
+            if size is None:
+                self.send_error(404)
+                return
+            self.send_part(size, head=True)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            size = fake_plex.part_size(url.path)
+            if size is not None:
+                fake_plex.count(requests=1)
+                if fake_plex.latency:
+                    time.sleep(fake_plex.latency)
+                self.send_part(size)
+                return
+
+            body = fake_plex.handle(url.path, parse_qs(url.query))
+
+            if body is None:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            payload = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        # concurrent clients connect at once, the default backlog (5) drops them into 1s SYN retries
+        request_queue_size = 128
+        daemon_threads = True
+
+    server = Server((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_shape_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--nodes", type=int, default=1)
+    parser.add_argument("--movie-libraries", type=int, default=1)
+    parser.add_argument("--movies", type=int, default=5000, help="per movie library")
+    parser.add_argument("--show-libraries", type=int, default=1)
+    parser.add_argument("--shows", type=int, default=100, help="per show library")
+    parser.add_argument("--seasons", type=int, default=3, help="per show")
+    parser.add_argument("--episodes", type=int, default=10, help="per season")
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every response")
+
+
+def from_arguments(args: argparse.Namespace) -> FakePlex:
+    return FakePlex(
+        nodes=args.nodes,
+        movie_libraries=args.movie_libraries,
+        movies=args.movies,
+        show_libraries=args.show_libraries,
+        shows=args.shows,
+        seasons=args.seasons,
+        episodes=args.episodes,
+        latency=args.latency,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=32400)
+    add_shape_arguments(parser)
+    args = parser.parse_args()
+
+    server = serve(from_arguments(args), host=args.host, port=args.port)
+    print(f"fake plex listening on http://{args.host}:{server.server_port}")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Micro-benchmark for the crawl path normalization, compares the per-file regex approach
+process_media used to run against tasks.utilities.cleanup_path + strip_common_paths.
+
+    PYTHONPATH=rq python bench/normalize_paths.py --paths 1000000
+
+The synthetic base paths have no regex metacharacters and don't repeat inside the paths, the only cases where
+the per-file re.sub and strip_common_paths agree (see tests/test_utilities.py for the ones where they don't).
+"""
+
+import argparse
+import random
+import re
+import time
+
+from tasks.utilities import cleanup_path, cleanup_segment, get_common_paths, strip_common_paths
+
+
+def legacy_cleanup_path(path: str = None) -> str:
+    path_segments = list(filter(lambda x: len(x) > 2, path.split("/")))
+    path_segments = list(map(lambda p: re.sub(r"(?:(.+)(\[.*\]))$", r"\1", p).strip(), path_segments))
+    path_segments = list(map(lambda p: re.sub(r"^(\[.*?\])(.*)", r"\2", p).strip(), path_segments))
+
+    return "/".join(path_segments)
+
+
+def legacy_strip_common_paths(paths: list, base_paths: list) -> list:
+    stripped_paths = []
+    for path in paths:
+        for base_path in base_paths:
+            path = re.sub(rf"{base_path}/", "", path).lstrip("/")
+        stripped_paths.append(path)
+
+    return stripped_paths
+
+
+def synthetic_paths(count: int, seed: int = 42) -> list:
+    rnd = random.Random(seed)
+    roots = ["/data/media/shows", "/mnt/disk1/tv", "/volume1/Plex/TV Shows [4K]"]
+    shows = [f"[grp] Show {i} ({rnd.randint(1950, 2024)}) [tvdb-{i}]" for i in range(max(count // 200, 1))]
+
+    paths = []
+    while len(paths) < count:
+        show = rnd.choice(shows)
+        season = rnd.randint(1, 12)
+        episode = rnd.randint(1, 24)
+        paths.append(
+            f"{rnd.choice(roots)}/{show}/Season {season:02}/"
+            f"{show} - S{season:02}E{episode:02} [WEBDL-1080p].mkv###{show.split(' [')[0]}"
+        )
+
+    return paths
+
+
+def timed(label: str, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    print(f"{label:<32}{time.perf_counter() - start:>10.3f}s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--paths", type=int, default=1_000_000)
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+
+    raw_paths = synthetic_paths(args.paths)
+    print(f"{len(raw_paths)} synthetic paths")
+
+    cleaned = timed("cleanup_path (cold cache)", lambda: [cleanup_path(p) for p in raw_paths])
+    timed("cleanup_path (warm cache)", lambda: [cleanup_path(p) for p in raw_paths])
+    base_paths = timed("get_common_paths", get_common_paths, cleaned)
+    stripped = timed("strip_common_paths", strip_common_paths, cleaned, base_paths)
+    print(f"segment cache: {cleanup_segment.cache_info()}")
+
+    if not args.skip_legacy:
+        legacy_cleaned = timed("legacy cleanup_path", lambda: [legacy_cleanup_path(p) for p in raw_paths])
+        legacy_stripped = timed("legacy re.sub per base path", legacy_strip_common_paths, legacy_cleaned, base_paths)
+
+        assert legacy_cleaned == cleaned, "cleanup_path output differs from the legacy implementation"
+        assert legacy_stripped == stripped, "strip_common_paths output differs from the legacy implementation"
+        print("outputs match the legacy implementation")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Benchmark of the app streaming proxy (PROXY_FILES=true) against bench/fake_plex.py, on fakeredis (default)
+or a local redis (db 11 is flushed!).
+
+    PYTHONPATH=rq python bench/proxy_stream.py --requests 400 --concurrency 16 --range-size 1048576
+    PYTHONPATH=rq python bench/proxy_stream.py --pool-size 0
+
+The app runs in uvicorn inside this process, the node index is written straight through _publish_generation.
+Range requests spread over the files measure throughput, time to first byte and how many connections the
+proxy opened to the node (keep-alive reuse, --pool-size 0 opens one per request); a client that reads slowly
+shows how far the reads from the node run ahead of it (backpressure).
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+
+from crawl_pipeline import percentile, setup_redis
+from fake_plex import FakePlex, serve
+
+MIB = 1024 * 1024
+
+
+def start_app(app) -> int:
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server.servers[0].sockets[0].getsockname()[1]
+
+
+async def ranges(args: argparse.Namespace, base_url: str, files: list) -> tuple:
+    import httpx
+
+    rng = random.Random(1)
+    ttfb, total, received, mismatches = [], [], 0, 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def fetch(client: httpx.AsyncClient, url: str, first: int):
+        nonlocal received, mismatches
+        async with semaphore:
+            started = time.perf_counter()
+            headers = {"Range": f"bytes={first}-{first + args.range_size - 1}"}
+            async with client.stream("GET", url, headers=headers) as response:
+                ttfb.append(time.perf_counter() - started)
+                body_start = None
+                async for chunk in response.aiter_raw():
+                    body_start = chunk[:1] if body_start is None else body_start
+                    received += len(chunk)
+            total.append(time.perf_counter() - started)
+            # fake_plex files are bytes 0..255 over and over
+            if response.status_code != 206 or body_start != bytes([first % 256]):
+                mismatches += 1
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(fetch(client, rng.choice(files), rng.randrange(0, 1_000_000_000)) for _ in range(args.requests))
+        )
+        wall = time.perf_counter() - started
+
+    return wall, ttfb, total, received, mismatches
+
+
+async def slow_client(args: argparse.Namespace, base_url: str, url: str, fake_plex: FakePlex) -> tuple:
+    # reads --slow-rate bytes per second, samples how much more the node has sent than the client read
+    import httpx
+
+    ahead, received = [], 0
+    sent_before = fake_plex.bytes_sent
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        async with client.stream("GET", url, headers={"Range": f"bytes=0-{512 * MIB - 1}"}) as response:
+            started = time.perf_counter()
+            async for chunk in response.aiter_raw():
+                received += len(chunk)
+                ahead.append(fake_plex.bytes_sent - sent_before - received)
+                await asyncio.sleep(max(received / args.slow_rate - (time.perf_counter() - started), 0))
+                if time.perf_counter() - started > args.slow_seconds:
+                    break
+
+    # the node stops being read once the client is gone
+    await asyncio.sleep(1)
+    sent_after_close = fake_plex.bytes_sent
+    await asyncio.sleep(1)
+    return received, max(ahead), fake_plex.bytes_sent - sent_after_close
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--redis", default=None, help="host:port of a local redis instead of fakeredis")
+    parser.add_argument("--nodes", type=int, default=2)
+    parser.add_argument("--files", type=int, default=200, help="per node")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--range-size", type=int, default=MIB, help="bytes per range request")
+    parser.add_argument("--pool-size", type=int, default=16, help="PROXY_POOL_SIZE, 0 disables keep-alive")
+    parser.add_argument("--latency", type=float, default=0, help="seconds the node takes to answer")
+    parser.add_argument("--slow-rate", type=int, default=4 * MIB, help="bytes per second of the slow client")
+    parser.add_argument("--slow-seconds", type=float, default=3)
+    args = parser.parse_args()
+
+    os.environ.update({"PROXY_FILES": "true", "PROXY_POOL_SIZE": str(args.pool_size)})
+    setup_redis(args)
+
+    fake_plex = FakePlex(nodes=args.nodes, movies=args.files, show_libraries=0, latency=args.latency)
+    upstream = serve(fake_plex)
+
+    import tasks.plex_reshare as plex_reshare
+
+    files = []
+    for node in fake_plex.nodes:
+        plex_reshare.r.hset(
+            f"pr:node:{node}",
+            mapping={
+                "ip": "127.0.0.1",
+                "port": upstream.server_port,
+                "token": f"token-{node}",
+                "connections": f"127.0.0.1:{upstream.server_port}",
+                "latency": 1,
+            },
+        )
+        medias = {f"Movie {i}/Movie {i}.mkv": f"/_/{node}/library/parts/1{i}/file.mkv" for i in range(args.files)}
+        plex_reshare._publish_generation(plex_server={"node": node}, media_type="movies", medias=medias)
+        files += [f"/movies/{node}/{media_path}" for media_path in medias]
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+    os.chdir(sys.path[0])
+    import main as app_main
+
+    # the fake nodes speak plain http
+    app_main.proxy.UPSTREAM_SCHEME = "http"
+    base_url = f"http://127.0.0.1:{start_app(app_main.app)}"
+    print(f"{args.nodes} node(s), {len(files)} files, pool size {args.pool_size}, node latency {args.latency}s")
+
+    wall, ttfb, total, received, mismatches = asyncio.run(ranges(args, base_url, files))
+    print(f"{'range requests':<32}{len(total):>12}  ({args.range_size} bytes, {args.concurrency} at once)")
+    print(f"{'wall time':<32}{wall:>11.3f}s")
+    print(f"{'throughput':<32}{len(total) / wall:>9.1f}/s  {received / MIB / wall:>8.1f} MiB/s")
+    print(
+        f"{'time to first byte':<32}p50 {percentile(ttfb, 50) * 1000:>8.2f}ms"
+        f"  p99 {percentile(ttfb, 99) * 1000:>8.2f}ms"
+    )
+    print(
+        f"{'request time':<32}p50 {percentile(total, 50) * 1000:>8.2f}ms"
+        f"  p99 {percentile(total, 99) * 1000:>8.2f}ms"
+    )
+    print(f"{'node requests':<32}{fake_plex.requests:>12}")
+    print(
+        f"{'node connections opened':<32}{fake_plex.connections:>12}"
+        f"  ({1 - fake_plex.connections / max(fake_plex.requests, 1):.1%} of the requests reused one)"
+    )
+    print(f"{'wrong responses':<32}{mismatches:>12}")
+
+    slow_received, ahead, after_close = asyncio.run(slow_client(args, base_url, files[0], fake_plex))
+    print(f"{'slow client read':<32}{slow_received / MIB:>11.1f}M  ({args.slow_rate / MIB:.1f} MiB/s)")
+    print(f"{'node ahead of it (max)':<32}{ahead / MIB:>11.1f}M")
+    print(f"{'node sent after it left':<32}{after_close / MIB:>11.1f}M")
+
+
+if __name__ == "__main__":
+    main()
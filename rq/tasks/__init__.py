@@ -1,23 +1,33 @@
+from .merge import merge_media
 from .plex_reshare import (
     get_episodes,
     get_movies,
     get_plex_libraries,
     get_plex_library,
+    get_plex_library_episodes,
     get_plex_playlists,
     get_plex_servers,
     get_seasons,
     get_shows,
+    prefetch_media,
+    probe_plex_servers,
     process_media,
 )
+from .snapshot import save_snapshot
 
 __all__ = [
     "get_plex_servers",
+    "probe_plex_servers",
     "get_plex_libraries",
     "get_plex_library",
+    "get_plex_library_episodes",
     "get_plex_playlists",
     "get_movies",
     "get_shows",
     "get_seasons",
     "get_episodes",
     "process_media",
+    "merge_media",
+    "prefetch_media",
+    "save_snapshot",
 ]
@@ -0,0 +1,64 @@
+import concurrent.futures
+import socket
+import ssl
+import time
+
+from . import metrics
+from .plex_client import PLEX_CONNECT_TIMEOUT
+
+PROBE_CONCURRENCY = 32
+
+_ssl_context = ssl.create_default_context()
+
+
+def resolve_hosts(hosts: set = None) -> dict:
+    # custom domains of the servers, resolved all at once
+    def resolve(host: str):
+        try:
+            return socket.gethostbyname(host)
+        except OSError:
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PROBE_CONCURRENCY) as executor:
+        return dict(zip(hosts, executor.map(resolve, hosts)))
+
+
+def _probe(node: str = None, connection: dict = None) -> dict:
+    # tcp connect (~ round trip) and tls handshake, the same certificate checks as the crawl requests
+    started = time.perf_counter()
+
+    try:
+        with socket.create_connection((connection["ip"], connection["port"]), timeout=PLEX_CONNECT_TIMEOUT) as sock:
+            connected = time.perf_counter()
+            with _ssl_context.wrap_socket(sock, server_hostname=connection["uri"].split(":")[0]):
+                handshaken = time.perf_counter()
+    except OSError:
+        metrics.observe("pr_connection_probe_seconds", time.perf_counter() - started, node=node, status="error")
+        return {**connection, "rtt": None, "tls": None}
+
+    metrics.observe("pr_connection_probe_seconds", handshaken - started, node=node, status="ok")
+    return {
+        **connection,
+        "rtt": round((connected - started) * 1000, 1),
+        "tls": round((handshaken - connected) * 1000, 1),
+    }
+
+
+def rank_connections(plex_servers: list = None) -> list:
+    # every connection of every server is probed at the same time; reachable ones come first, fastest
+    # first, the others keep their discovery order at the end (still worth a try when everything fails)
+    probes = [
+        (plex_server, connection)
+        for plex_server in plex_servers
+        for connection in plex_server.get("connections") or [{key: plex_server[key] for key in ["uri", "ip", "port"]}]
+    ]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PROBE_CONCURRENCY) as executor:
+        results = list(executor.map(lambda probe: _probe(probe[0]["node"], probe[1]), probes))
+
+    for plex_server in plex_servers:
+        connections = [result for (ps, _), result in zip(probes, results) if ps is plex_server]
+        connections.sort(key=lambda c: (c["rtt"] is None, (c["rtt"] or 0) + (c["tls"] or 0)))
+        plex_server.update({key: connections[0][key] for key in ["uri", "ip", "port"]}, connections=connections)
+
+    return plex_servers
@@ -0,0 +1,67 @@
+import itertools
+import os
+
+from .plex_reshare import MERGED_NODE, _publish_generation, r
+from .utilities import get_media_identity
+
+
+def merge_media(media_type: str = None) -> None:
+    # node publishes raise pr:merge:<media_type> and queue this job once, what they publish while it
+    # runs is picked up by another round
+    while r.delete(f"pr:merge:{media_type}"):
+        _merge_media(media_type=media_type)
+
+
+def _merge_media(media_type: str = None) -> None:
+    # merged view of the current index of every node: a file shared by several servers is listed once,
+    # its resolution record holds every "node\tpart key" serving it and the proxy picks one per request
+    pointers = sorted(
+        key for key in r.scan_iter(match=f"pr:gen:{media_type}/*", count=1000) if key.split("/")[-1] != MERGED_NODE
+    )
+    sources = {}
+    sources_stats = {}
+
+    for pointer in pointers:
+        gen = r.get(pointer)
+        if not gen:
+            continue
+
+        node_location = pointer.removeprefix("pr:gen:")
+        node = node_location.split("/")[-1]
+        pipe = r.pipeline(transaction=False)
+        pipe.hgetall(f"pr:g:{gen}:files:{node_location}")
+        pipe.hgetall(f"pr:g:{gen}:meta:{node_location}")
+        files, metas = pipe.execute()
+
+        for media_path, media_key in files.items():
+            media_size, _, media_mtime = (metas.get(media_path) or "").partition("\t")
+            # items crawled without a size are never considered duplicates
+            identity = get_media_identity(media_path, media_size) if media_size else f"{node}\t{media_path}"
+
+            sources.setdefault(identity, []).append((node, media_path, media_key))
+            if media_size and identity not in sources_stats:
+                sources_stats[identity] = (int(media_size), int(media_mtime or 0))
+
+    medias = {}
+    medias_stats = {}
+
+    for identity, media_sources in sources.items():
+        node, media_path, _ = media_sources[0]
+        if media_path in medias:
+            # another release under the same name, tagged with the shortest form of its node that's still free
+            media_stem, media_ext = os.path.splitext(media_path)
+            for tag in itertools.chain((node[:8], node), (f"{node} {i}" for i in itertools.count(2))):
+                if f"{media_stem} [{tag}]{media_ext}" not in medias:
+                    break
+            media_path = f"{media_stem} [{tag}]{media_ext}"
+
+        medias[media_path] = "\n".join(f"{node}\t{media_key}" for node, _, media_key in media_sources)
+        if identity in sources_stats:
+            medias_stats[media_path] = sources_stats[identity]
+
+    _publish_generation(
+        plex_server={"node": MERGED_NODE},
+        media_type=media_type,
+        medias=medias,
+        medias_stats=medias_stats,
+    )
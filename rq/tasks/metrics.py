@@ -0,0 +1,70 @@
+import collections
+import time
+
+import redis
+from starlette.config import Config
+
+config = Config()
+METRICS_FLUSH_INTERVAL = 5
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SLOW_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# every process buffers its increments and adds them to pr:metrics (prometheus series -> value) every few
+# seconds, the app renders that hash on /metrics so one scrape sees all the workers
+_buffer = collections.Counter()
+_types = {}
+_last_flush = time.monotonic()
+
+r = redis.Redis(
+    host=config("REDIS_HOST", default="localhost"),
+    port=config("REDIS_PORT", cast=int, default=6379),
+    db=11,
+    decode_responses=True,
+)
+
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _series(name: str = None, labels: dict = None) -> str:
+    labels = ",".join(f'{key}="{_label_value(value)}"' for key, value in labels.items())
+    return f"{name}{{{labels}}}" if labels else name
+
+
+def inc(name: str = None, value: float = 1, **labels) -> None:
+    _types[name] = "counter"
+    _buffer[_series(name, labels)] += value
+    _maybe_flush()
+
+
+def observe(name: str = None, value: float = None, buckets: tuple = DEFAULT_BUCKETS, **labels) -> None:
+    _types[name] = "histogram"
+
+    for bucket in buckets:
+        if value <= bucket:
+            _buffer[_series(f"{name}_bucket", {**labels, "le": bucket})] += 1
+    _buffer[_series(f"{name}_bucket", {**labels, "le": "+Inf"})] += 1
+    _buffer[_series(f"{name}_sum", labels)] += value
+    _buffer[_series(f"{name}_count", labels)] += 1
+    _maybe_flush()
+
+
+def _maybe_flush() -> None:
+    if time.monotonic() - _last_flush > METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+def flush() -> None:
+    global _last_flush
+    _last_flush = time.monotonic()
+
+    if not _buffer:
+        return
+
+    pipe = r.pipeline(transaction=False)
+    pipe.hset("pr:metrics:types", mapping=_types)
+    for series, value in _buffer.items():
+        pipe.hincrbyfloat("pr:metrics", series, value)
+    _buffer.clear()
+    pipe.execute()
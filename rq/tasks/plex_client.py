@@ -0,0 +1,122 @@
+import email.utils
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from starlette.config import Config
+
+from rq import get_current_job
+
+from . import metrics, profiling
+from .utilities import redis_connection
+
+config = Config()
+PLEX_RATE_LIMIT = config("PLEX_RATE_LIMIT", cast=float, default=3.0)
+PLEX_RATE_BURST = config("PLEX_RATE_BURST", cast=int, default=5)
+PLEX_CONNECT_TIMEOUT = config("PLEX_CONNECT_TIMEOUT", cast=float, default=5.0)
+PLEX_READ_TIMEOUT = config("PLEX_READ_TIMEOUT", cast=float, default=30.0)
+PLEX_POOL_SIZE = config("PLEX_POOL_SIZE", cast=int, default=4)
+PLEX_MAX_THROTTLED = 3
+PLEX_MAX_RETRY_AFTER = 120
+HEADERS = {
+    "Accept": "application/json",
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15"
+    " (KHTML, like Gecko) Version/16.6 Safari/605.1.15",
+}
+
+# keep-alive sessions, one per plex node, reused by every job the worker runs
+_sessions = {}
+
+# token bucket shared by every worker through redis; the token is always taken and the call
+# returns how many ms the caller has to wait before it's allowed to use it
+_take_token = redis_connection.register_script(
+    """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+
+    local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+    local tokens = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000) - 1
+    redis.call("HSET", KEYS[1], "tokens", tokens, "ts", now)
+    redis.call("PEXPIRE", KEYS[1], math.ceil((burst - tokens) * 1000 / rate) + 1000)
+
+    if tokens >= 0 then
+        return 0
+    end
+    return math.ceil(-tokens * 1000 / rate)
+    """
+)
+
+
+def _get_session(node: str) -> requests.Session:
+    session = _sessions.get(node)
+
+    if not session:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=PLEX_POOL_SIZE)
+        session = requests.Session()
+        session.headers.update(HEADERS)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _sessions[node] = session
+
+    return session
+
+
+def _wait_for_token(node: str) -> None:
+    wait_ms = _take_token(
+        keys=[f"pr:ratelimit:{node}"],
+        args=[PLEX_RATE_LIMIT, PLEX_RATE_BURST, int(time.time() * 1000)],
+    )
+    if wait_ms:
+        time.sleep(wait_ms / 1000)
+
+
+def _get_retry_after(response: requests.Response, attempt: int = 0) -> float:
+    retry_after = response.headers.get("Retry-After", "").strip()
+
+    try:
+        if retry_after.isdigit():
+            seconds = int(retry_after)
+        else:
+            seconds = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+    except (TypeError, ValueError):
+        # no (usable) header, back off a bit more on every attempt
+        seconds = 2 ** (attempt + 1)
+
+    return min(max(seconds, 1), PLEX_MAX_RETRY_AFTER)
+
+
+def plex_get(node: str = None, url: str = None, timeout: tuple = None, headers: dict = None) -> requests.Response:
+    session = _get_session(node)
+    job = get_current_job()
+    task = job.func_name.removeprefix("tasks.") if job else ""
+
+    for attempt in range(PLEX_MAX_THROTTLED + 1):
+        with profiling.phase("ratelimit"):
+            _wait_for_token(node)
+        started = time.perf_counter()
+        try:
+            with profiling.phase("http"):
+                response = session.get(
+                    url=url, timeout=timeout or (PLEX_CONNECT_TIMEOUT, PLEX_READ_TIMEOUT), headers=headers
+                )
+        except requests.RequestException:
+            metrics.observe(
+                "pr_plex_request_seconds", time.perf_counter() - started, node=node, task=task, status="error"
+            )
+            raise
+        metrics.observe(
+            "pr_plex_request_seconds", time.perf_counter() - started, node=node, task=task, status=response.status_code
+        )
+
+        if response.status_code not in (429, 503) or attempt == PLEX_MAX_THROTTLED:
+            break
+
+        with profiling.phase("ratelimit"):
+            time.sleep(_get_retry_after(response, attempt=attempt))
+
+    response.raise_for_status()
+    return response
@@ -3,38 +3,76 @@ import itertools
 import json
 import os
 import random
-import re
-import socket
 import string
 import time
-from urllib.parse import urlencode, urlparse
+from urllib.parse import quote, urlencode, urlparse
 
 import pickledb
 import redis
 import requests
 from starlette.config import Config
 
-import rq
-
-from .utilities import cleanup_path, get_common_paths, redis_connection
+from rq import get_current_job
+from rq.job import Callback
+
+from . import metrics, profiling
+from .connections import rank_connections, resolve_hosts
+from .plex_client import plex_get
+from .pool import crawl_queue, discovery_queue, enqueue_once, index_queue, rq_retries
+from .utilities import (
+    MediaFilter,
+    cleanup_path,
+    get_common_paths,
+    get_dir_children,
+    get_dir_stats,
+    get_search_entries,
+    get_sort_key,
+    get_trigrams,
+    normalize_title,
+    strip_common_paths,
+)
 
 config = Config()
 PLEX_TOKEN = config("PLEX_TOKEN", cast=str, default="")
 DEVELOPMENT = config("DEVELOPMENT", cast=bool, default=False)
 IGNORE_PLAYLIST = config("IGNORE_PLAYLIST", cast=str, default="")
-REDIS_REFRESH_TTL = 3 * 60 * 60
 REDIS_PATH_TTL = 24 * 60 * 60
+REDIS_GEN_GRACE = 10 * 60
+PIPELINE_BATCH = 5000
 IGNORE_EXTENSIONS = config("IGNORE_EXTENSIONS", cast=str, default="").split(',') + [None]
 IGNORE_RESOLUTIONS = config("IGNORE_RESOLUTIONS", cast=str, default="").split(',') + [None]
 IGNORE_MOVIE_TEMPLATES = [i for i in config("IGNORE_MOVIE_TEMPLATES", cast=str, default="").split('|') if i]
 IGNORE_EPISODE_TEMPLATES = [i for i in config("IGNORE_EPISODE_TEMPLATES", cast=str, default="").split('|') if i]
 MOVIE_MIN_SIZE = config("MOVIE_MIN_SIZE", cast=int, default=512)
 EPISODE_MIN_SIZE = config("EPISODE_MIN_SIZE", cast=int, default=64)
-HEADERS = {
-    "Accept": "application/json",
-    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15"
-    " (KHTML, like Gecko) Version/16.6 Safari/605.1.15",
-}
+MOVIE_FILTER = MediaFilter(
+    extensions=IGNORE_EXTENSIONS,
+    resolutions=IGNORE_RESOLUTIONS,
+    templates=IGNORE_MOVIE_TEMPLATES,
+    min_size=MOVIE_MIN_SIZE,
+)
+EPISODE_FILTER = MediaFilter(
+    extensions=IGNORE_EXTENSIONS,
+    resolutions=IGNORE_RESOLUTIONS,
+    templates=IGNORE_EPISODE_TEMPLATES,
+    min_size=EPISODE_MIN_SIZE,
+)
+PLAYLIST_PAGE_SIZE = 200
+PROXY_URL = config("PROXY_URL", cast=str, default="http://127.0.0.1:8080")
+CHUNK_PREFETCH = config("CHUNK_PREFETCH", cast=bool, default=False)
+CHUNK_PREFETCH_MAX = config("CHUNK_PREFETCH_MAX", cast=int, default=500)
+CHUNK_CACHE_HEAD = config("CHUNK_CACHE_HEAD", cast=int, default=8 * 1024 * 1024)
+CHUNK_CACHE_TAIL = config("CHUNK_CACHE_TAIL", cast=int, default=4 * 1024 * 1024)
+FLAT_EPISODES = config("FLAT_EPISODES", cast=bool, default=True)
+FLAT_EPISODES_PAGE_SIZE = min(max(config("FLAT_EPISODES_PAGE_SIZE", cast=int, default=250), 100), 500)
+FLAT_EPISODES_FALLBACK_TTL = 24 * 60 * 60
+FULL_SYNC_INTERVAL = config("FULL_SYNC_INTERVAL", cast=int, default=48) * 60 * 60
+SYNC_TTL = 2 * FULL_SYNC_INTERVAL
+SYNC_STALE = 30 * 60
+MERGED_VIEW = config("MERGED_VIEW", cast=bool, default=False)
+INDEX_REBUILD_INTERVAL = config("INDEX_REBUILD_INTERVAL", cast=int, default=5) * 60
+CRAWL_TTL = 24 * 60 * 60
+MERGED_NODE = "all"
 
 r = redis.Redis(
     host=config("REDIS_HOST", default="localhost"),
@@ -42,8 +80,17 @@ r = redis.Redis(
     db=11,
     decode_responses=True,
 )
-rq_queue = rq.Queue(name="default", connection=redis_connection)
-rq_retries = rq.Retry(max=3, interval=[10, 30, 120])
+
+_expire_generation = r.register_script(
+    """
+    local keys = redis.call("SMEMBERS", KEYS[1])
+    for _, key in ipairs(keys) do
+        redis.call("EXPIRE", key, ARGV[1])
+    end
+    redis.call("EXPIRE", KEYS[1], ARGV[1])
+    return #keys + 1
+    """
+)
 
 
 def _get_pickledb(autodump: bool = True):
@@ -74,45 +121,56 @@ def _get_servers() -> list[dict]:
         "X-Plex-Token": PLEX_TOKEN,
     }
 
-    req = requests.get(
+    req = plex_get(
+        node="plex.tv",
         url=f"https://clients.plex.tv/api/v2/resources?{urlencode(query_params)}",
-        headers=HEADERS,
     )
 
-    servers = {}
-    for server in [server for server in req.json() if server["provides"] == "server"]:
-        for conn in server["connections"]:
-            if not conn["relay"] and not conn["local"] and not conn["IPv6"]:
-                custom_access = False
-                if "plex.direct" not in conn["uri"]:
-                    custom_access = True
-
-                    s = [c for c in server["connections"] if "plex.direct" in c["uri"]]
-
-                    url = urlparse(conn["uri"])
-                    server_ip = socket.gethostbyname(url.netloc.split(":")[0])
-                    conn["uri"] = (
-                        f"{server_ip.replace('.', '-')}.{s[0]['uri'].split('.')[1]}.plex.direct:{conn['port']}"
-                    )
+    resources = [server for server in req.json() if server["provides"] == "server"]
+    for server in resources:
+        server["connections"] = [
+            c for c in server["connections"] if not c["relay"] and not c["local"] and not c["IPv6"]
+        ]
+    addresses = resolve_hosts(
+        {
+            urlparse(c["uri"]).hostname
+            for server in resources
+            for c in server["connections"]
+            if "plex.direct" not in c["uri"]
+        }
+    )
 
-                uri = conn["uri"].split("://")[-1]
-                node = uri.split(".")[1]
-                ip = uri.split(".")[0].replace("-", ".")
-                port = conn["port"]
-                token = server["accessToken"]
-                owned = server["owned"]
-
-                if not servers.get(server["clientIdentifier"]) or custom_access:
-                    servers[server["clientIdentifier"]] = {
-                        "node": node,
-                        "uri": uri,
-                        "ip": ip,
-                        "port": port,
-                        "token": token,
-                        "owned": owned,
-                    }
+    servers = []
+    for server in resources:
+        connections = []
+        for conn in server["connections"]:
+            custom_access = "plex.direct" not in conn["uri"]
+            if custom_access:
+                # custom access, reached through the plex.direct name of its ip
+                s = [c for c in server["connections"] if "plex.direct" in c["uri"]]
+                server_ip = addresses.get(urlparse(conn["uri"]).hostname)
+                if not s or not server_ip:
+                    continue
+                conn["uri"] = f"{server_ip.replace('.', '-')}.{s[0]['uri'].split('.')[1]}.plex.direct:{conn['port']}"
+
+            uri = conn["uri"].split("://")[-1]
+            connection = {"uri": uri, "ip": uri.split(".")[0].replace("-", "."), "port": conn["port"]}
+            if connection not in connections:
+                # custom access used to be the preferred connection, it stays first among equals
+                connections.insert(0 if custom_access else len(connections), connection)
+
+        if connections:
+            servers.append(
+                {
+                    "node": connections[0]["uri"].split(".")[1],
+                    **{key: connections[0][key] for key in ["uri", "ip", "port"]},
+                    "token": server["accessToken"],
+                    "owned": server["owned"],
+                    "connections": connections,
+                }
+            )
 
-    return list(servers.values())
+    return rank_connections(servers)
 
 
 def get_plex_playlists(plex_servers: list = None) -> None:
@@ -133,7 +191,7 @@ def get_plex_playlists(plex_servers: list = None) -> None:
 
     query_params_items = {
         "X-Plex-Container-Start": 0,
-        "X-Plex-Container-Size": 120,
+        "X-Plex-Container-Size": PLAYLIST_PAGE_SIZE,
         "X-Plex-Client-Identifier": "".join(
             random.choices(string.ascii_uppercase + string.ascii_lowercase + string.digits, k=24)
         ),
@@ -144,21 +202,25 @@ def get_plex_playlists(plex_servers: list = None) -> None:
     ignored_items = []
 
     for plex_server in [ps for ps in plex_servers if ps["owned"]]:
-        playlists = requests.get(
+        playlists = plex_get(
+            node=plex_server["node"],
             url=f"https://{plex_server['uri']}/playlists?{urlencode(query_params)}",
-            timeout=15,
-            headers=HEADERS,
         )
 
         for playlist in playlists.json()["MediaContainer"]["Metadata"]:
-            if playlist["title"] == IGNORE_PLAYLIST:
-                playlist_items = requests.get(
+            if playlist["title"] != IGNORE_PLAYLIST:
+                continue
+
+            # walk the whole playlist, not only its first page
+            offset, total_size = 0, 1
+            while offset < total_size:
+                query_params_items["X-Plex-Container-Start"] = offset
+                playlist_items = plex_get(
+                    node=plex_server["node"],
                     url=f"https://{plex_server['uri']}{playlist['key']}?{urlencode(query_params_items)}",
-                    timeout=15,
-                    headers=HEADERS,
-                )
+                ).json()["MediaContainer"]
 
-                for ignore_item in playlist_items.json()["MediaContainer"]["Metadata"]:
+                for ignore_item in playlist_items.get("Metadata", []):
                     for media in ignore_item["Media"]:
                         for part in media["Part"]:
                             ignored_items.append(
@@ -168,78 +230,316 @@ def get_plex_playlists(plex_servers: list = None) -> None:
                                 .strip("/")
                             )
 
-                if db.exists("ignores"):
-                    existing_ignore_items = db.get("ignores")
-                    ignored_items = list(set(ignored_items + existing_ignore_items))
+                offset += playlist_items.get("size", 0) or PLAYLIST_PAGE_SIZE
+                total_size = playlist_items.get("totalSize", playlist_items.get("size", 0))
+
+            if db.exists("ignores"):
+                existing_ignore_items = db.get("ignores")
+                ignored_items = list(set(ignored_items + existing_ignore_items))
 
-                db.set("ignores", ignored_items)
+            db.set("ignores", ignored_items)
 
 
 def get_plex_servers() -> None:
+    # runs on the refresh schedule (see scheduler.py), new nodes get their first library refresh right away
     db = _get_pickledb(autodump=True)
-    rkey = "pr:servers"
 
-    if not r.exists(rkey):
-        time.sleep(random.randint(1, 20 if DEVELOPMENT else 60))
+    plex_servers = _get_servers()
+    r.set("pr:servers", json.dumps(plex_servers))
 
-    if not r.exists(rkey):
-        plex_servers = _get_servers()
-        r.set(rkey, json.dumps(plex_servers))
-        r.expire(rkey, int(REDIS_REFRESH_TTL / 3))
-        rq_queue.enqueue_in(
-            datetime.timedelta(seconds=int(REDIS_REFRESH_TTL / 3 + 60)), "tasks.get_plex_servers", retry=rq_retries
-        )
+    if IGNORE_PLAYLIST:
+        discovery_queue.enqueue("tasks.get_plex_playlists", at_front=True, retry=rq_retries, plex_servers=plex_servers)
 
-        if IGNORE_PLAYLIST:
-            rq_queue.enqueue("tasks.get_plex_playlists", at_front=True, retry=rq_retries, plex_servers=plex_servers)
-
-        if not db.exists("ignores"):
-            db.set("ignores", [])
-    else:
-        plex_servers = json.loads(r.get(rkey))
+    if not db.exists("ignores"):
+        db.set("ignores", [])
 
     for plex_server in [ps for ps in plex_servers if not ps["owned"]]:
-        rkey_node_refresh = f"pr:node:{plex_server['node']}:refresh"
-        rkey_node_ip = f"pr:node:{plex_server['node']}:ip"
-        rkey_node_port = f"pr:node:{plex_server['node']}:port"
-        rkey_node_token = f"pr:node:{plex_server['node']}:token"
-
-        # no need to refresh
-        if r.exists(rkey_node_refresh):
-            continue
+        _store_node(plex_server)
+        r.zadd("pr:schedule", {f"libraries:{plex_server['node']}": time.time()}, nx=True)
+
+
+def _store_node(plex_server: dict = None) -> None:
+    # everything the proxy needs to reach the node, read together with the file in one lookup;
+    # the connections are ranked fastest first and the proxy fails over along them, the latency (ms) of the
+    # best one picks between the servers of a merged file
+    best = plex_server["connections"][0]
+    r.hset(
+        f"pr:node:{plex_server['node']}",
+        mapping={
+            **{key: plex_server[key] for key in ["ip", "port", "token"]},
+            "connections": " ".join(f"{c['ip']}:{c['port']}" for c in plex_server["connections"]),
+            "latency": best["rtt"] + best["tls"] if best.get("rtt") is not None else "",
+        },
+    )
 
-        r.set(rkey_node_refresh, str(datetime.datetime.now()))
-        r.expire(
-            rkey_node_refresh,
-            random.randint(6, 12) * random.randint(50, 60) * 60,
-        )
 
-        r.set(rkey_node_ip, plex_server["ip"])
-        r.set(rkey_node_port, str(plex_server["port"]))
-        r.set(rkey_node_token, plex_server["token"])
+def probe_plex_servers() -> None:
+    # keeps the connections ranking current in between two discoveries
+    plex_servers = rank_connections(json.loads(r.get("pr:servers") or "[]"))
+    r.set("pr:servers", json.dumps(plex_servers))
 
-        rq_queue.enqueue("tasks.get_plex_libraries", retry=rq_retries, kwargs={"plex_server": plex_server})
+    for plex_server in [ps for ps in plex_servers if not ps["owned"]]:
+        _store_node(plex_server)
 
 
 def get_plex_libraries(plex_server: dict = None) -> None:
     query_params = {"X-Plex-Token": plex_server["token"]}
-    libraries = requests.get(
+    libraries = plex_get(
+        node=plex_server["node"],
         url=f"https://{plex_server['uri']}/library/sections?{urlencode(query_params)}",
-        timeout=15,
-        headers=HEADERS,
     )
 
+    flat_episodes = FLAT_EPISODES and not r.exists(f"pr:node:{plex_server['node']}:noflat")
+
     for library in libraries.json()["MediaContainer"]["Directory"]:
-        if library["type"] in ["movie", "show"]:
-            rq_queue.enqueue(
-                "tasks.get_plex_library",
-                retry=rq_retries,
-                kwargs={
-                    "plex_server": plex_server,
-                    "library": library,
-                    "offset": 0,
-                },
-            )
+        # jobs only carry what the crawl needs, not the whole plex metadata
+        library = {"key": library["key"], "type": library["type"]}
+
+        if library["type"] == "movie":
+            _start_library_sync(plex_server=plex_server, library=library, media_type="movies")
+        elif library["type"] == "show" and flat_episodes:
+            _start_library_sync(plex_server=plex_server, library=library, media_type="shows")
+        elif library["type"] == "show":
+            _start_shows_crawl(plex_server=plex_server, library=library)
+
+
+def _start_shows_crawl(plex_server: dict = None, library: dict = None) -> None:
+    # show -> season -> episode crawls fan out, pr:crawl:<node>:<library> holds the ids of the jobs still to
+    # run; a crawl of the library that's still going is left alone (a stuck one expires, see end_stuck_crawl)
+    if r.exists(f"pr:crawl:{plex_server['node']}:{library['key']}"):
+        return
+
+    _add_crawl_jobs(
+        plex_server=plex_server,
+        library_key=library["key"],
+        func="tasks.get_plex_library",
+        jobs={
+            f"get_plex_library:{plex_server['node']}:{library['key']}:0": {
+                "plex_server": plex_server,
+                "library": library,
+                "offset": 0,
+            }
+        },
+    )
+
+
+def _add_crawl_jobs(
+    plex_server: dict = None, library_key: str = None, func: str = None, jobs: dict = None, at_front: bool = False
+) -> None:
+    # job id -> kwargs, the ids are added before the jobs are queued (and before the job queueing them is done)
+    # so the crawl never looks finished half way; they are derived from what the job crawls, a retried job
+    # queues the same ids again instead of new ones that would never be removed
+    if not jobs:
+        return
+
+    rkey_crawl = f"pr:crawl:{plex_server['node']}:{library_key}"
+    pipe = r.pipeline(transaction=True)
+    pipe.sadd(rkey_crawl, *jobs)
+    pipe.expire(rkey_crawl, CRAWL_TTL)
+    pipe.zadd("pr:schedule", {f"crawl:{plex_server['node']}:{library_key}": time.time() + CRAWL_TTL})
+    pipe.execute()
+
+    queue = crawl_queue(plex_server["node"])
+    for job_id, kwargs in jobs.items():
+        queue.enqueue(
+            func, job_id=job_id, retry=rq_retries, on_failure=CRAWL_JOB_FAILED, at_front=at_front, kwargs=kwargs
+        )
+
+
+def _finish_crawl_job(plex_server: dict = None, library_key: str = None, job_id: str = None) -> None:
+    # the last job of the crawl rebuilds the index for good, the others at most once in a while; a job that
+    # runs twice (queued again by a retried parent) only counts once
+    rkey_crawl = f"pr:crawl:{plex_server['node']}:{library_key}"
+    pipe = r.pipeline(transaction=True)
+    pipe.srem(rkey_crawl, job_id or get_current_job().id)
+    pipe.scard(rkey_crawl)
+    pipe.expire(rkey_crawl, CRAWL_TTL)
+    removed, left, _ = pipe.execute()
+
+    done = bool(removed) and not left
+    if done:
+        r.zrem("pr:schedule", f"crawl:{plex_server['node']}:{library_key}")
+    elif left:
+        r.zadd("pr:schedule", {f"crawl:{plex_server['node']}:{library_key}": time.time() + CRAWL_TTL}, xx=True)
+
+    _request_process_media(plex_server=plex_server, media_type="shows", final=done)
+
+
+def _crawl_job_failed(job, connection, exc_type, exc_value, traceback) -> None:
+    # rq failure callback of the crawl jobs: a job that failed for good (no retry left, timeout...) is done too,
+    # the rest of the crawl still gets indexed
+    if job.retries_left:
+        return
+
+    library_key = job.kwargs.get("library_key") or job.kwargs["library"]["key"]
+    _finish_crawl_job(plex_server=job.kwargs["plex_server"], library_key=library_key, job_id=job.id)
+
+
+CRAWL_JOB_FAILED = Callback(_crawl_job_failed)
+
+
+def end_stuck_crawl(plex_server: dict = None, library_key: str = None) -> None:
+    # the crawl ids expired with jobs that never finished (lost with a dead worker...), what was stored is
+    # indexed anyway, the next libraries refresh starts the crawl over
+    r.delete(f"pr:crawl:{plex_server['node']}:{library_key}")
+    _request_process_media(plex_server=plex_server, media_type="shows", final=True)
+
+
+def _request_process_media(plex_server: dict = None, media_type: str = None, final: bool = False) -> None:
+    # interim rebuilds while libraries are crawled: at most one every INDEX_REBUILD_INTERVAL per node & media
+    # type, the end of a library crawl always asks for one; requests that pile up collapse into the job
+    # that's already queued, one made while it runs makes it go again (see process_media)
+    rkey_rebuild = f"pr:rebuild:{plex_server['node']}:{media_type}"
+    if not final and not (
+        INDEX_REBUILD_INTERVAL and r.set(f"{rkey_rebuild}:interim", 1, nx=True, ex=INDEX_REBUILD_INTERVAL)
+    ):
+        return
+
+    r.set(rkey_rebuild, int(time.time()), ex=CRAWL_TTL)
+    enqueue_once(
+        index_queue,
+        "tasks.process_media",
+        job_id=f"process_media:{media_type}:{plex_server['node']}",
+        kwargs={"plex_server": plex_server, "media_type": media_type},
+    )
+
+
+def _get_library_query(plex_server: dict = None, library: dict = None, query_params: dict = None) -> str:
+    url = f"https://{plex_server['uri']}/library/sections/{library['key']}/all?{urlencode(query_params)}"
+
+    # only items changed since the last crawl of the library
+    sync = r.hgetall(f"pr:sync:{plex_server['node']}:{library['key']}")
+    if sync.get("mode") == "delta":
+        url += f"&updatedAt>={sync['since']}"
+
+    return url
+
+
+def _start_library_sync(plex_server: dict = None, library: dict = None, media_type: str = None) -> None:
+    # movies & flat episodes libraries keep their crawl state between runs:
+    # last seen updatedAt watermark, items count, last full crawl and the page a running crawl reached
+    rkey_sync = f"pr:sync:{plex_server['node']}:{library['key']}"
+    rkey_medias = f"pr:{media_type}:{plex_server['node']}:{library['key']}"
+    library_task = "get_plex_library" if media_type == "movies" else "get_plex_library_episodes"
+    sync = r.hgetall(rkey_sync)
+    now = int(time.time())
+
+    if sync.get("offset"):
+        # crawl still running, or resume it from the last checkpoint
+        if now - int(sync["ts"]) < SYNC_STALE:
+            return
+        offset = int(sync["offset"])
+    else:
+        query_params = {
+            "X-Plex-Token": plex_server["token"],
+            "X-Plex-Container-Start": 0,
+            "X-Plex-Container-Size": 0,
+        }
+        if media_type == "shows":
+            query_params["type"] = 4
+
+        try:
+            library_count = plex_get(
+                node=plex_server["node"],
+                url=f"https://{plex_server['uri']}/library/sections/{library['key']}/all?{urlencode(query_params)}",
+            ).json()["MediaContainer"]["totalSize"]
+        except (requests.RequestException, ValueError, KeyError):
+            if media_type != "shows":
+                raise
+
+            # the count is the first flat request to the server, the other libraries still get crawled
+            _fall_back_to_shows_crawl(plex_server=plex_server, library=library)
+            return
+
+        # reconcile everything once in a while or when items went away, deltas don't see deletions
+        full_sync = (
+            not r.exists(rkey_medias)
+            or now - int(sync.get("full_at", 0)) > FULL_SYNC_INTERVAL
+            or library_count < int(sync.get("count", 0))
+        )
+
+        offset = 0
+        r.delete(f"{rkey_medias}:next")
+        r.hset(
+            rkey_sync,
+            mapping={
+                "mode": "full" if full_sync else "delta",
+                "since": sync.get("updated_at", 0),
+                "target": f"{rkey_medias}:next" if full_sync and r.exists(rkey_medias) else rkey_medias,
+                "offset": 0,
+                "ts": now,
+                "next_updated_at": sync.get("updated_at", 0),
+                "next_count": library_count,
+            },
+        )
+        r.sadd(f"pr:{media_type}:{plex_server['node']}:libraries", library["key"])
+
+    crawl_queue(plex_server["node"]).enqueue(
+        f"tasks.{library_task}",
+        retry=rq_retries,
+        kwargs={
+            "plex_server": plex_server,
+            "library": library,
+            "offset": offset,
+        },
+    )
+
+
+def _restart_library_sync(plex_server: dict = None, library: dict = None, media_type: str = None) -> None:
+    # the sync state expired or was reset under a running crawl, start over from the library count
+    if media_type == "shows" and r.exists(f"pr:node:{plex_server['node']}:noflat"):
+        _start_shows_crawl(plex_server=plex_server, library=library)
+    else:
+        _start_library_sync(plex_server=plex_server, library=library, media_type=media_type)
+
+
+def _fall_back_to_shows_crawl(plex_server: dict = None, library: dict = None) -> None:
+    # older/odd servers, remember it and go the show -> season -> episode way
+    r.set(f"pr:node:{plex_server['node']}:noflat", str(datetime.datetime.now()), ex=FLAT_EPISODES_FALLBACK_TTL)
+    r.delete(f"pr:sync:{plex_server['node']}:{library['key']}")
+    _start_shows_crawl(plex_server=plex_server, library=library)
+
+
+def _checkpoint_library_sync(plex_server: dict = None, library: dict = None, media_container: dict = None) -> bool:
+    # returns True once the last page of the library was stored
+    rkey_sync = f"pr:sync:{plex_server['node']}:{library['key']}"
+    sync = r.hgetall(rkey_sync)
+
+    updated_at = max(
+        [int(sync.get("next_updated_at", 0))]
+        + [int(item.get("updatedAt", item.get("addedAt", 0))) for item in media_container.get("Metadata", [])]
+    )
+    offset = media_container["offset"] + media_container["size"]
+
+    if offset < media_container["totalSize"]:
+        r.hset(rkey_sync, mapping={"offset": offset, "ts": int(time.time()), "next_updated_at": updated_at})
+        return False
+
+    rkey_medias = sync["target"].removesuffix(":next")
+    now = int(time.time())
+
+    pipe = r.pipeline(transaction=True)
+    if sync["target"] != rkey_medias:
+        # a full sync that stored nothing (empty or fully ignored library) has no :next hash to rename
+        if r.exists(sync["target"]):
+            pipe.rename(sync["target"], rkey_medias)
+        else:
+            pipe.delete(rkey_medias)
+    pipe.expire(rkey_medias, SYNC_TTL)
+    pipe.hset(
+        rkey_sync,
+        mapping={
+            "updated_at": updated_at,
+            "count": sync["next_count"] if sync["mode"] == "delta" else media_container["totalSize"],
+            "synced_at": now,
+            "full_at": now if sync["mode"] == "full" else sync.get("full_at", 0),
+        },
+    )
+    pipe.hdel(rkey_sync, "mode", "since", "target", "offset", "ts", "next_updated_at", "next_count")
+    pipe.expire(rkey_sync, SYNC_TTL)
+    pipe.execute()
+
+    return True
 
 
 def get_plex_library(
@@ -253,100 +553,157 @@ def get_plex_library(
         "X-Plex-Container-Size": 100,
     }
 
-    library_res = requests.get(
-        url=f"https://{plex_server['uri']}/library/sections/{library['key']}/all?{urlencode(query_params)}",
-        headers=HEADERS,
+    library_res = plex_get(
+        node=plex_server["node"],
+        url=_get_library_query(plex_server=plex_server, library=library, query_params=query_params),
     )
-
     media_container = library_res.json()["MediaContainer"]
-    rq_queue.enqueue(
-        f"tasks.get_{library['type']}s", kwargs={"media_container": media_container, "plex_server": plex_server}
-    )
+    _count_page(plex_server=plex_server, library_key=library["key"], media_container=media_container)
+
+    if library["type"] == "show":
+        get_shows(media_container=media_container, plex_server=plex_server, library_key=library["key"])
+
+        if media_container["size"] + media_container["offset"] < media_container["totalSize"]:
+            _add_crawl_jobs(
+                plex_server=plex_server,
+                library_key=library["key"],
+                func="tasks.get_plex_library",
+                jobs={
+                    f"get_plex_library:{plex_server['node']}:{library['key']}:{offset + 100}": {
+                        "plex_server": plex_server,
+                        "library": library,
+                        "offset": offset + 100,
+                    }
+                },
+                at_front=True,
+            )
+        _finish_crawl_job(plex_server=plex_server, library_key=library["key"])
+        return
 
-    if media_container["size"] + media_container["offset"] < media_container["totalSize"]:
-        offset += 100
-        rq_queue.enqueue_in(
-            datetime.timedelta(seconds=offset / (10 if library["type"] == "show" else 50)),
+    # the page is stored before the checkpoint moves on, a restarted crawl never skips items
+    rkey_target = r.hget(f"pr:sync:{plex_server['node']}:{library['key']}", "target")
+    if not rkey_target:
+        _restart_library_sync(plex_server=plex_server, library=library, media_type="movies")
+        return
+
+    get_movies(media_container=media_container, plex_server=plex_server, rkey_medias=rkey_target)
+
+    done = _checkpoint_library_sync(plex_server=plex_server, library=library, media_container=media_container)
+    _request_process_media(plex_server=plex_server, media_type="movies", final=done)
+
+    if not done:
+        crawl_queue(plex_server["node"]).enqueue(
             "tasks.get_plex_library",
             retry=rq_retries,
             at_front=True,
             kwargs={
                 "plex_server": plex_server,
                 "library": library,
-                "offset": offset,
+                "offset": offset + media_container["size"],
             },
         )
 
 
-def get_movies(media_container: dict = None, plex_server: dict = None) -> None:
-    movies_list = {}
-
-    for movie in media_container["Metadata"]:
-        for media in movie["Media"]:
-            if media.get("videoResolution") in IGNORE_RESOLUTIONS:
-                continue
-
-            for part in media["Part"]:
-                movie_key = part.get("key")
-                movie_path = part.get("file")
-
-                if (
-                    not movie_key
-                    or not movie_path
-                    or part.get("container") in IGNORE_EXTENSIONS
-                    or part.get("size", 1) / 1000000 < MOVIE_MIN_SIZE
-                ):
-                    continue
-
-                movie_file = movie_path.split("/")[-1]
+def get_plex_library_episodes(
+    plex_server: dict = None,
+    library: dict = None,
+    offset: int = None,
+) -> None:
+    # page through all the episodes of a show library at once instead of show -> season -> episode
+    query_params = {
+        "type": 4,
+        "X-Plex-Token": plex_server["token"],
+        "X-Plex-Container-Start": offset,
+        "X-Plex-Container-Size": FLAT_EPISODES_PAGE_SIZE,
+        "includeUserState": 0,
+    }
 
-                # ignore file that match a specific name-template
-                if any(re.match(rf"{imt}", movie_file, flags=re.I) for imt in IGNORE_MOVIE_TEMPLATES):
-                    continue
+    try:
+        library_res = plex_get(
+            node=plex_server["node"],
+            url=_get_library_query(plex_server=plex_server, library=library, query_params=query_params),
+        )
+        media_container = library_res.json()["MediaContainer"]
 
-                movie_path = cleanup_path(path=movie_path)
-                movies_list[movie_key] = f"{movie_path}###{movie['title']} ({movie.get('year')})".replace(
-                    " (None)", ""
-                )
+        if any(episode.get("type") != "episode" for episode in media_container.get("Metadata", [])):
+            raise ValueError("server doesn't list episodes by section")
+    except (requests.RequestException, ValueError, KeyError):
+        if offset:
+            raise
 
-    rkey_movies = f"pr:movies:{plex_server['node']}"
-    if r.exists(rkey_movies):
-        existing_movies_list = r.hgetall(rkey_movies)
-        movies_list.update(existing_movies_list)
+        _fall_back_to_shows_crawl(plex_server=plex_server, library=library)
+        return
 
-    if len(movies_list):
-        r.hmset(rkey_movies, movies_list)
-        r.expire(rkey_movies, 60 * 60)
+    _count_page(plex_server=plex_server, library_key=library["key"], media_container=media_container)
+    rkey_target = r.hget(f"pr:sync:{plex_server['node']}:{library['key']}", "target")
+    if not rkey_target:
+        _restart_library_sync(plex_server=plex_server, library=library, media_type="shows")
+        return
 
-    rq_queue.enqueue_in(
-        datetime.timedelta(seconds=random.randint(10, 60)),
-        "tasks.process_media",
-        retry=rq_retries,
-        kwargs={
-            "plex_server": plex_server,
-            "media_type": "movies",
-        },
-    )
+    _store_episodes(media_container=media_container, rkey_medias=rkey_target, rkey_ttl=SYNC_TTL)
 
+    done = _checkpoint_library_sync(plex_server=plex_server, library=library, media_container=media_container)
+    _request_process_media(plex_server=plex_server, media_type="shows", final=done)
 
-def get_shows(media_container: dict = None, plex_server: dict = None) -> None:
-    for sid, show in enumerate(media_container["Metadata"]):
-        # rq_queue.enqueue_in(
-        #     datetime.timedelta(seconds=sid * 5),
-        rq_queue.enqueue(
-            "tasks.get_seasons",
+    if not done:
+        crawl_queue(plex_server["node"]).enqueue(
+            "tasks.get_plex_library_episodes",
             retry=rq_retries,
             at_front=True,
             kwargs={
-                "show": show,
                 "plex_server": plex_server,
-                "show_count": sid,
+                "library": library,
+                "offset": offset + media_container["size"],
             },
         )
 
 
-def get_seasons(show: dict = None, plex_server: dict = None, show_count: int = 0):
-    time.sleep(0.2)
+def get_movies(media_container: dict = None, plex_server: dict = None, rkey_medias: str = None) -> None:
+    movies_list = {}
+
+    # filtering & paths cleanup of the page items
+    with profiling.phase("filter"):
+        for movie in media_container.get("Metadata", []):
+            for media in movie["Media"]:
+                if MOVIE_FILTER.skip_media(media):
+                    continue
+
+                for part in media["Part"]:
+                    # ignore file that match a specific name-template
+                    if MOVIE_FILTER.skip_part(part, name=part.get("file", "").split("/")[-1]):
+                        continue
+
+                    movie_key = part["key"]
+                    movie_path = cleanup_path(path=part["file"])
+                    movie_placeholder = f"{movie['title']} ({movie.get('year')})".replace(" (None)", "")
+                    movie_mtime = movie.get("updatedAt", movie.get("addedAt", 0))
+                    movies_list[movie_key] = (
+                        f"{movie_path}###{movie_placeholder}\t{part.get('size', 0)}\t{movie_mtime}"
+                    )
+
+    _store_medias(rkey_medias=rkey_medias, medias_list=movies_list, rkey_ttl=SYNC_TTL)
+
+
+def get_shows(media_container: dict = None, plex_server: dict = None, library_key: str = None) -> None:
+    r.sadd(f"pr:shows:{plex_server['node']}:libraries", library_key)
+    _add_crawl_jobs(
+        plex_server=plex_server,
+        library_key=library_key,
+        func="tasks.get_seasons",
+        jobs={
+            f"get_seasons:{plex_server['node']}:{show['key']}": {
+                "show": {"key": show["key"]},
+                "plex_server": plex_server,
+                "show_count": sid,
+                "library_key": library_key,
+            }
+            for sid, show in enumerate(media_container["Metadata"])
+        },
+        at_front=True,
+    )
+
+
+def get_seasons(show: dict = None, plex_server: dict = None, show_count: int = 0, library_key: str = None):
     query_params = {
         "X-Plex-Token": plex_server["token"],
         "X-Plex-Container-Start": 0,
@@ -355,27 +712,34 @@ def get_seasons(show: dict = None, plex_server: dict = None, show_count: int = 0
         "includeUserState": 0,
     }
 
-    seasons = requests.get(
+    seasons = plex_get(
+        node=plex_server["node"],
         url=f"https://{plex_server['uri']}{show['key']}?{urlencode(query_params)}",
-        timeout=10,
-        headers=HEADERS,
     )
 
-    seasons_metadata = seasons.json()["MediaContainer"]["Metadata"]
-    for sid, season in enumerate(seasons_metadata):
-        # rq_queue.enqueue(
-        rq_queue.enqueue_in(
-            datetime.timedelta(seconds=sid * 10 + show_count),
-            "tasks.get_episodes",
-            retry=rq_retries,
-            # at_front=True,
-            kwargs={"season": season, "plex_server": plex_server, "last_season": sid + 1 == len(seasons_metadata)},
-        )
-
+    _add_crawl_jobs(
+        plex_server=plex_server,
+        library_key=library_key,
+        func="tasks.get_episodes",
+        jobs={
+            f"get_episodes:{plex_server['node']}:{season['key']}:0": {
+                "season": {"key": season["key"]},
+                "plex_server": plex_server,
+                "library_key": library_key,
+            }
+            for season in seasons.json()["MediaContainer"]["Metadata"]
+        },
+    )
+    _finish_crawl_job(plex_server=plex_server, library_key=library_key)
 
-def get_episodes(season: dict = None, plex_server: dict = None, offset: int = 0, last_season: bool = False) -> None:
-    episodes_list = {}
 
+def get_episodes(
+    season: dict = None,
+    plex_server: dict = None,
+    offset: int = 0,
+    last_season: bool = False,  # jobs queued by older versions
+    library_key: str = None,
+) -> None:
     query_params = {
         "X-Plex-Token": plex_server["token"],
         "X-Plex-Container-Start": offset,
@@ -384,93 +748,122 @@ def get_episodes(season: dict = None, plex_server: dict = None, offset: int = 0,
         "includeUserState": 0,
     }
 
-    episodes = requests.get(
+    episodes = plex_get(
+        node=plex_server["node"],
         url=f"https://{plex_server['uri']}{season['key']}?{urlencode(query_params)}",
-        timeout=10,
-        headers=HEADERS,
     )
 
     media_container = episodes.json()["MediaContainer"]
-    for episode in media_container["Metadata"]:
-        for media in episode["Media"]:
-            if media.get("videoResolution") in IGNORE_RESOLUTIONS:
-                continue
+    _count_page(plex_server=plex_server, library_key=library_key, media_container=media_container)
+    _store_episodes(
+        media_container=media_container,
+        rkey_medias=f"pr:shows:{plex_server['node']}:{library_key}",
+        rkey_ttl=60 * 60,
+    )
+
+    if media_container["size"] + media_container["offset"] < media_container["totalSize"]:
+        offset += 100
+        _add_crawl_jobs(
+            plex_server=plex_server,
+            library_key=library_key,
+            func="tasks.get_episodes",
+            jobs={
+                f"get_episodes:{plex_server['node']}:{season['key']}:{offset}": {
+                    "season": season,
+                    "plex_server": plex_server,
+                    "offset": offset,
+                    "library_key": library_key,
+                }
+            },
+        )
 
-            for part in media["Part"]:
-                episode_key = part.get("key")
-                episode_path = part.get("file")
+    _finish_crawl_job(plex_server=plex_server, library_key=library_key)
 
-                if (
-                    not episode_key
-                    or not episode_path
-                    or part.get("container") in IGNORE_EXTENSIONS
-                    or part.get("size", 1) / 1000000 < EPISODE_MIN_SIZE
-                ):
-                    continue
 
-                # ignore file that match a specific path-template
-                if any(re.match(rf"{imt}", episode_path.lower(), flags=re.I) for imt in IGNORE_EPISODE_TEMPLATES):
+def _count_page(plex_server: dict = None, library_key: str = None, media_container: dict = None) -> None:
+    metrics.inc("pr_crawl_pages_total", node=plex_server["node"], library=library_key)
+    metrics.inc(
+        "pr_crawl_items_total", len(media_container.get("Metadata", [])), node=plex_server["node"], library=library_key
+    )
+
+
+def _store_episodes(media_container: dict = None, rkey_medias: str = None, rkey_ttl: int = None) -> None:
+    episodes_list = {}
+
+    # filtering & paths cleanup of the page items
+    with profiling.phase("filter"):
+        for episode in media_container.get("Metadata", []):
+            for media in episode["Media"]:
+                if EPISODE_FILTER.skip_media(media):
                     continue
 
-                episode_path = cleanup_path(path=episode_path)
-                episodes_list[episode_key] = episode_path
+                for part in media["Part"]:
+                    # ignore file that match a specific path-template
+                    if EPISODE_FILTER.skip_part(part, name=part.get("file", "").lower()):
+                        continue
 
-    rkey_shows = f"pr:shows:{plex_server['node']}"
-    if r.exists(rkey_shows):
-        existing_episodes_list = r.hgetall(rkey_shows)
-        episodes_list.update(existing_episodes_list)
+                    episode_path = cleanup_path(path=part["file"])
+                    episode_mtime = episode.get("updatedAt", episode.get("addedAt", 0))
+                    episodes_list[part["key"]] = f"{episode_path}\t{part.get('size', 0)}\t{episode_mtime}"
 
-    if len(episodes_list):
-        r.hmset(rkey_shows, episodes_list)
-        r.expire(rkey_shows, 60 * 60)
+    _store_medias(rkey_medias=rkey_medias, medias_list=episodes_list, rkey_ttl=rkey_ttl)
 
-    if media_container["size"] + media_container["offset"] < media_container["totalSize"]:
-        offset += 100
-        rq_queue.enqueue_in(
-            datetime.timedelta(seconds=offset / 5),
-            "tasks.get_episodes",
-            retry=rq_retries,
-            kwargs={
-                "season": season,
-                "plex_server": plex_server,
-                "offset": offset,
-            },
-        )
 
-    if last_season:
-        rq_queue.enqueue_in(
-            datetime.timedelta(seconds=random.randint(5, 120)),
-            "tasks.process_media",
-            retry=rq_retries,
-            kwargs={
-                "plex_server": plex_server,
-                "media_type": "shows",
-            },
-        )
+def _store_medias(rkey_medias: str = None, medias_list: dict = None, rkey_ttl: int = None) -> None:
+    # only the page's items are written, on top of what other pages/workers already stored
+    if not medias_list:
+        return
+
+    pipe = r.pipeline(transaction=True)
+    pipe.hset(rkey_medias, mapping=medias_list)
+    pipe.expire(rkey_medias, rkey_ttl)
+    pipe.execute()
 
 
 def process_media(plex_server: dict = None, media_type: str = None):
+    # rebuild requested while this one ran: one more round picks up what the crawl stored meanwhile
+    rkey_rebuild = f"pr:rebuild:{plex_server['node']}:{media_type}"
+    r.delete(rkey_rebuild)
+    _process_media(plex_server=plex_server, media_type=media_type)
+
+    while r.delete(rkey_rebuild):
+        _process_media(plex_server=plex_server, media_type=media_type)
+
+
+def _process_media(plex_server: dict = None, media_type: str = None):
     time.sleep(0.5)
+    started = time.perf_counter()
     medias_list = {}
     db = _get_pickledb(autodump=False)
-    ignored_items = db.get("ignores") or []
-
-    rkey_medias = f"pr:{media_type}:{plex_server['node']}"
-    if r.exists(rkey_medias):
-        medias_list = r.hgetall(rkey_medias)
+    ignored_items = set(db.get("ignores") or [])
+
+    # crawled items are kept per library
+    pipe = r.pipeline(transaction=False)
+    for library_key in r.smembers(f"pr:{media_type}:{plex_server['node']}:libraries"):
+        pipe.hgetall(f"pr:{media_type}:{plex_server['node']}:{library_key}")
+    for library_medias in pipe.execute():
+        medias_list.update(library_medias)
+
+    # "path###placeholder\tsize\tmtime", size & mtime are missing for items crawled by older versions
+    medias_meta = {}
+    for media_key, media_value in medias_list.items():
+        media_path, _, media_meta = media_value.partition("\t")
+        media_size, _, media_mtime = media_meta.partition("\t")
+        medias_list[media_key] = media_path
+        if media_meta:
+            medias_meta[media_key] = (int(media_size), int(media_mtime))
 
     base_paths = get_common_paths(list(medias_list.values()))
     medias_list = dict(sorted(medias_list.items(), key=lambda x: x[1]))
     medias_list = dict(itertools.islice(medias_list.items(), _get_max_files())).items()
 
-    delete_keys = list(r.scan_iter(f"pr:files:{media_type}/{plex_server['node']}*"))
+    media_paths = strip_common_paths([media_path for _, media_path in medias_list], base_paths)
     medias = {}
+    medias_stats = {}
+    medias_titles = {}
 
-    for media_key, media_path in medias_list:
-        for base_path in base_paths:
-            # media_path = re.sub(rf"^{base_path}/", "", media_path).lstrip("/")
-            media_path = re.sub(rf"{base_path}/", "", media_path).lstrip("/")
-
+    for (media_key, _), media_path in zip(medias_list, media_paths):
+        media_base_placeholder = None
         if "###" in media_path:
             media_path, media_base_placeholder = media_path.split("###")
             media_path_chunks = list(filter(None, media_path.split("/")))
@@ -483,16 +876,200 @@ def process_media(plex_server: dict = None, media_type: str = None):
         if exclude_key in ignored_items:
             continue
 
-        media_path = f"pr:files:{media_type}/{plex_server['node']}/{media_path}"
-        medias[media_key] = media_path
+        medias[media_path] = media_key
+        if media_key in medias_meta:
+            medias_stats[media_path] = medias_meta[media_key]
+        if media_base_placeholder:
+            medias_titles[media_path] = media_base_placeholder
+
+    _publish_generation(
+        plex_server=plex_server,
+        media_type=media_type,
+        medias=medias,
+        medias_stats=medias_stats,
+        medias_titles=medias_titles,
+    )
+    metrics.observe(
+        "pr_process_media_seconds",
+        time.perf_counter() - started,
+        buckets=metrics.SLOW_BUCKETS,
+        media_type=media_type,
+        node=plex_server["node"],
+    )
 
-    delete_keys = [x for x in delete_keys if x not in set(list(medias.values()))]
 
-    pipe = r.pipeline()
-    if len(delete_keys) > 1:
-        r.delete(*delete_keys)
+def _publish_generation(
+    plex_server: dict = None,
+    media_type: str = None,
+    medias: dict = None,
+    medias_stats: dict = None,
+    medias_titles: dict = None,
+) -> None:
+    # write a brand-new generation of the node index, then flip the pointer to it in one go;
+    # readers resolve pr:gen:<media_type>/<node> first so they never see a half-built tree
+    node_location = f"{media_type}/{plex_server['node']}"
+    merged = plex_server["node"] == MERGED_NODE
+    gen = r.incr("pr:gen")
+    rkey_files = f"pr:g:{gen}:files:{node_location}"
+    rkey_meta = f"pr:g:{gen}:meta:{node_location}"
+    rkey_published = f"pr:g:{gen}:published"
+    rkey_keys = f"pr:g:{gen}:keys"
+    published = int(time.time())
+
+    gen_keys = [rkey_files, rkey_meta, rkey_published]
+    pipe = r.pipeline(transaction=False)
+    pipe.set(rkey_published, published, ex=REDIS_PATH_TTL)
+
+    medias_items = list(medias.items())
+    for i in range(0, len(medias_items), PIPELINE_BATCH):
+        pipe.hset(rkey_files, mapping=dict(medias_items[i : i + PIPELINE_BATCH]))
+
+    # "size\tmtime" of every file and folder (total size, newest file) for the listings
+    medias_stats = {**(medias_stats or {}), **get_dir_stats(medias_stats or {})}
+    medias_stats = [(path, f"{size}\t{mtime}") for path, (size, mtime) in medias_stats.items()]
+    for i in range(0, len(medias_stats), PIPELINE_BATCH):
+        pipe.hset(rkey_meta, mapping=dict(medias_stats[i : i + PIPELINE_BATCH]))
+
+    gen_keys += _write_search_index(
+        pipe=pipe, gen=gen, node_location=node_location, medias=medias, medias_titles=medias_titles
+    )
+
+    dir_children = get_dir_children([f"{node_location}/{media_path}" for media_path in medias])
+    for parent, children in dir_children.items():
+        if parent != node_location and not parent.startswith(f"{node_location}/"):
+            continue
 
-    for media_key, media_path in medias.items():
-        r.set(media_path, media_key)
-        r.expire(media_path, REDIS_PATH_TTL)
+        # scored in listing order (by name, case insensitive), the app pages through folders by rank
+        rkey_dir = f"pr:g:{gen}:dirs:{parent}"
+        children = sorted(children, key=get_sort_key)
+        pipe.zadd(rkey_dir, {child: position for position, child in enumerate(children)})
+        pipe.expire(rkey_dir, REDIS_PATH_TTL)
+        gen_keys.append(rkey_dir)
+
+        if len(pipe) >= PIPELINE_BATCH:
+            pipe.execute()
+
+    for i in range(0, len(gen_keys), PIPELINE_BATCH):
+        pipe.sadd(rkey_keys, *gen_keys[i : i + PIPELINE_BATCH])
+    pipe.expire(rkey_files, REDIS_PATH_TTL)
+    pipe.expire(rkey_meta, REDIS_PATH_TTL)
+    pipe.expire(rkey_keys, REDIS_PATH_TTL)
     pipe.execute()
+
+    pipe = r.pipeline(transaction=True)
+    pipe.set(f"pr:gen:{node_location}", gen, ex=REDIS_PATH_TTL, get=True)
+    pipe.hset("pr:gen:latest", mapping={"gen": gen, "published": published})
+    # with the merged view only its folder is listed, node folders still resolve files
+    if medias and merged == MERGED_VIEW:
+        pipe.zadd(f"pr:dirs:{media_type}", {f"{plex_server['node']}/": 0})
+        pipe.zadd("pr:dirs:", {f"{media_type}/": 0})
+        pipe.expire(f"pr:dirs:{media_type}", REDIS_PATH_TTL)
+        pipe.expire("pr:dirs:", REDIS_PATH_TTL)
+    else:
+        pipe.zrem(f"pr:dirs:{media_type}", f"{plex_server['node']}/")
+    if not MERGED_VIEW:
+        pipe.zrem(f"pr:dirs:{media_type}", f"{MERGED_NODE}/")
+    old_gen = pipe.execute()[0]
+    metrics.inc("pr_index_keys_written_total", len(gen_keys) + 1, media_type=media_type, node=plex_server["node"])
+
+    if MERGED_VIEW and not merged:
+        r.set(f"pr:merge:{media_type}", published)
+        enqueue_once(
+            index_queue, "tasks.merge_media", job_id=f"merge_media:{media_type}", kwargs={"media_type": media_type}
+        )
+
+    if not old_gen:
+        return
+
+    # warm the proxy chunk cache for files that weren't there before (not on the very first build)
+    if CHUNK_PREFETCH and CHUNK_CACHE_HEAD and not merged:
+        old_medias = set(r.hkeys(f"pr:g:{old_gen}:files:{node_location}"))
+        new_medias = [media_path for media_path in medias if media_path not in old_medias]
+
+        if new_medias:
+            crawl_queue(plex_server["node"]).enqueue(
+                "tasks.prefetch_media",
+                kwargs={
+                    "plex_server": plex_server,
+                    "media_type": media_type,
+                    "media_paths": new_medias[:CHUNK_PREFETCH_MAX],
+                },
+            )
+
+    # previous generation goes away on its own once in-flight readers are done with it
+    expired = _expire_generation(keys=[f"pr:g:{old_gen}:keys"], args=[REDIS_GEN_GRACE])
+    metrics.inc("pr_index_keys_deleted_total", expired, media_type=media_type, node=plex_server["node"])
+
+
+def _write_search_index(
+    pipe: redis.client.Pipeline = None,
+    gen: int = None,
+    node_location: str = None,
+    medias: dict = None,
+    medias_titles: dict = None,
+) -> list:
+    # search entries of the generation (see app/main.py search):
+    # - search: zset of every word suffix of the title & folder name, "suffix\0id", prefix lookups by lex range
+    # - titles: id -> "folder\ttitle\ttrigrams count"
+    # - trigrams: trigram of the title -> "id,id,...", fuzzy lookups when prefixes find too little
+    rkey_search = f"pr:g:{gen}:search:{node_location}"
+    rkey_titles = f"pr:g:{gen}:titles:{node_location}"
+    rkey_trigrams = f"pr:g:{gen}:trigrams:{node_location}"
+    entries = get_search_entries(medias, medias_titles)
+    if not entries:
+        return []
+
+    suffixes = {}
+    titles = {}
+    trigrams = {}
+    for entry_id, (entry, title) in enumerate(entries.items()):
+        normalized_title = normalize_title(title)
+        entry_trigrams = get_trigrams(normalized_title)
+
+        for text in {normalized_title, normalize_title(entry.split("/")[-1])}:
+            words = text.split()
+            for i in range(len(words)):
+                suffixes[f"{' '.join(words[i:])}\0{entry_id}"] = 0
+        titles[entry_id] = f"{entry}\t{title}\t{len(entry_trigrams)}"
+        for trigram in entry_trigrams:
+            trigrams.setdefault(trigram, []).append(str(entry_id))
+
+    for rkey, mapping in [
+        (rkey_search, suffixes),
+        (rkey_titles, titles),
+        (rkey_trigrams, {trigram: ",".join(ids) for trigram, ids in trigrams.items()}),
+    ]:
+        items = list(mapping.items())
+        for i in range(0, len(items), PIPELINE_BATCH):
+            if rkey == rkey_search:
+                pipe.zadd(rkey, dict(items[i : i + PIPELINE_BATCH]))
+            else:
+                pipe.hset(rkey, mapping=dict(items[i : i + PIPELINE_BATCH]))
+            if len(pipe) >= PIPELINE_BATCH:
+                pipe.execute()
+        pipe.expire(rkey, REDIS_PATH_TTL)
+
+    return [rkey_search, rkey_titles, rkey_trigrams]
+
+
+def prefetch_media(plex_server: dict = None, media_type: str = None, media_paths: list = None) -> None:
+    # read the head & tail of the files through the local proxy, which keeps them in its chunk cache
+    for media_path in media_paths:
+        url = f"{PROXY_URL}/" + quote(f"{media_type}/{plex_server['node']}/{media_path}")
+
+        try:
+            head = plex_get(
+                node=plex_server["node"],
+                url=url,
+                headers={"Range": f"bytes=0-{CHUNK_CACHE_HEAD - 1}"},
+            )
+
+            media_size = head.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+            if media_size.isdigit() and int(media_size) > CHUNK_CACHE_HEAD:
+                plex_get(
+                    node=plex_server["node"],
+                    url=url,
+                    headers={"Range": f"bytes={int(media_size) - CHUNK_CACHE_TAIL}-{int(media_size) - 1}"},
+                )
+        except requests.RequestException:
+            continue
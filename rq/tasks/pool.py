@@ -0,0 +1,163 @@
+import time
+
+from starlette.config import Config
+
+import rq
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+from rq.registry import ScheduledJobRegistry
+
+from . import metrics, profiling
+from .utilities import redis_connection
+
+config = Config()
+RQ_WORKERS = max(config("RQ_WORKERS", cast=int, default=4), 1)
+CRAWL_NODE_CONCURRENCY = max(config("CRAWL_NODE_CONCURRENCY", cast=int, default=2), 1)
+CRAWL_QUEUE_PREFIX = "crawl:"
+POOL_POLL_INTERVAL = 5
+ENQUEUE_LOCK_TTL = 30
+SLOT_LEASE_MARGIN = 60
+CRAWL_SLOT_LEASE_MAX = 60 * 60
+
+rq_retries = rq.Retry(max=3, interval=[10, 30, 120])
+
+# workers go through the queues in this order: index rebuilds first, then discovery, then the crawls of
+# every node (round robin between them), "default" only drains jobs queued by older versions
+index_queue = rq.Queue(name="index", connection=redis_connection)
+discovery_queue = rq.Queue(name="discovery", connection=redis_connection)
+default_queue = rq.Queue(name="default", connection=redis_connection)
+
+# crawl slots of a node: workers currently running one of its jobs, each with a lease in case it dies mid-job
+_acquire_slot = redis_connection.register_script(
+    """
+    local now = tonumber(ARGV[3])
+    redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now)
+
+    if redis.call("ZSCORE", KEYS[1], ARGV[1]) or redis.call("ZCARD", KEYS[1]) < tonumber(ARGV[2]) then
+        redis.call("ZADD", KEYS[1], now + tonumber(ARGV[4]), ARGV[1])
+        redis.call("EXPIRE", KEYS[1], ARGV[4])
+        return 1
+    end
+    return 0
+    """
+)
+
+
+def crawl_queue(node: str = None) -> rq.Queue:
+    return rq.Queue(name=f"{CRAWL_QUEUE_PREFIX}{node}", connection=redis_connection)
+
+
+def _get_crawl_queues() -> list[rq.Queue]:
+    return sorted(
+        [queue for queue in rq.Queue.all(connection=redis_connection) if queue.name.startswith(CRAWL_QUEUE_PREFIX)],
+        key=lambda queue: queue.name,
+    )
+
+
+def enqueue_once(queue: rq.Queue = None, func: str = None, job_id: str = None, kwargs: dict = None) -> None:
+    # a job (refresh, index rebuild) that is still waiting or running is not queued a second time; workers
+    # and the scheduler asking for the same job at once go through a lock, only one of them checks & queues it
+    rkey_lock = f"pr:enqueue:{job_id}"
+    if not queue.connection.set(rkey_lock, 1, nx=True, ex=ENQUEUE_LOCK_TTL):
+        return
+
+    try:
+        try:
+            job = Job.fetch(job_id, connection=queue.connection)
+            if job.get_status() in (JobStatus.QUEUED, JobStatus.STARTED, JobStatus.SCHEDULED, JobStatus.DEFERRED):
+                return
+        except NoSuchJobError:
+            pass
+
+        queue.enqueue(func, job_id=job_id, retry=rq_retries, kwargs=kwargs or {})
+    finally:
+        queue.connection.delete(rkey_lock)
+
+
+def enqueue_scheduled_crawls() -> None:
+    # rq's own scheduler only looks after the queues the workers started with, crawl queues come and go
+    for queue in _get_crawl_queues():
+        registry = ScheduledJobRegistry(queue=queue)
+        job_ids = registry.get_jobs_to_schedule(int(time.time()))
+
+        for job in Job.fetch_many(job_ids, connection=redis_connection) if job_ids else []:
+            if job:
+                queue.enqueue_job(job, at_front=bool(job.enqueue_at_front))
+                registry.remove(job)
+
+
+class PoolWorker(rq.SimpleWorker):
+    # one worker of the pool (see worker.py), it listens to the crawl queues of the nodes that still have a
+    # free slot, so several nodes are crawled in parallel but a single node never by more than
+    # CRAWL_NODE_CONCURRENCY workers at once
+    def __init__(self, *args, **kwargs):
+        super().__init__([index_queue, discovery_queue, default_queue], *args, **kwargs)
+        self._crawl_offset = 0
+
+    def _refresh_queues(self) -> None:
+        crawl_queues = _get_crawl_queues()
+
+        if crawl_queues:
+            now = time.time()
+            pipe = self.connection.pipeline(transaction=False)
+            for queue in crawl_queues:
+                pipe.zcount(f"pr:slots:{queue.name[len(CRAWL_QUEUE_PREFIX) :]}", now, "+inf")
+            crawl_queues = [
+                queue for queue, used in zip(crawl_queues, pipe.execute()) if used < CRAWL_NODE_CONCURRENCY
+            ]
+
+        if crawl_queues:
+            self._crawl_offset = (self._crawl_offset + 1) % len(crawl_queues)
+            crawl_queues = crawl_queues[self._crawl_offset :] + crawl_queues[: self._crawl_offset]
+
+        self.queues = [index_queue, discovery_queue, *crawl_queues, default_queue]
+        self._ordered_queues = self.queues[:]
+
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        # short blocking rounds, new nodes and freed slots are picked up in between; rq's work loop quits as
+        # soon as this returns without a job, so what it checks between two dequeues (stop request,
+        # `rq suspend`) is checked here between the rounds too
+        while True:
+            self._refresh_queues()
+            if timeout is None:
+                # burst mode, one pass over the queues
+                return super().dequeue_job_and_maintain_ttl(None, max_idle_time=max_idle_time)
+
+            result = super().dequeue_job_and_maintain_ttl(POOL_POLL_INTERVAL, max_idle_time=POOL_POLL_INTERVAL)
+            if result is not None or self._stop_requested:
+                return result
+
+            self.check_for_suspension(burst=False)
+            if self._stop_requested:
+                return None
+
+    def _get_slot_lease(self, job) -> int:
+        # the slot is held for as long as rq lets the job run (its timeout), jobs run in-process and there is no
+        # heartbeat along the way to renew it; the lease only matters when a worker dies mid-job
+        timeout = job.timeout or self.queue_class.DEFAULT_TIMEOUT
+        return (timeout if timeout > 0 else CRAWL_SLOT_LEASE_MAX) + SLOT_LEASE_MARGIN
+
+    def execute_job(self, job, queue):
+        try:
+            with profiling.profile_job(job):
+                self._execute_job(job, queue)
+        finally:
+            metrics.flush()
+
+    def _execute_job(self, job, queue):
+        if not queue.name.startswith(CRAWL_QUEUE_PREFIX):
+            return super().execute_job(job, queue)
+
+        rkey_slots = f"pr:slots:{queue.name[len(CRAWL_QUEUE_PREFIX) :]}"
+        if not _acquire_slot(
+            keys=[rkey_slots],
+            args=[self.name, CRAWL_NODE_CONCURRENCY, time.time(), self._get_slot_lease(job)],
+        ):
+            # another worker took the last slot of the node in the meantime, the job goes back where it was
+            queue.enqueue_job(job, at_front=True)
+            return
+
+        try:
+            super().execute_job(job, queue)
+        finally:
+            self.connection.zrem(rkey_slots, self.name)
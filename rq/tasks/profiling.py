@@ -0,0 +1,232 @@
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+
+import redis
+import requests
+from starlette.config import Config
+
+from rq.job import Job
+
+from . import metrics
+from .utilities import redis_connection
+
+config = Config()
+# "phases": where the time of every job goes, "cprofile" / "sample": plus a pstats / folded stacks file of
+# the slowest jobs, empty: off
+TASK_PROFILING = config("TASK_PROFILING", cast=str, default="").lower()
+PROFILE_SLOWEST = max(config("PROFILE_SLOWEST", cast=int, default=10), 1)
+PROFILE_PATH = config("PROFILE_PATH", cast=str, default="/pr/profiles")
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILING = TASK_PROFILING in ("phases", "cprofile", "sample")
+
+# the job being run by this worker, phases only count while its task function runs
+_record = None
+
+
+class _Record:
+    def __init__(self):
+        self.phases = {}
+        self.calls = {}
+        self.task_time = 0
+        self.running = False
+        self.phase = None
+
+    def add(self, phase: str = None, seconds: float = None) -> None:
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+
+
+class _Phase:
+    # time spent in a phase, phases don't nest: whatever runs inside one (redis calls of the rate limiter...)
+    # belongs to it
+    def __init__(self, record: _Record = None, name: str = None):
+        self.record = record
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        if self.record.running and self.record.phase is None:
+            self.record.phase = self.name
+            self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.started is not None:
+            self.record.add(self.name, time.perf_counter() - self.started)
+            self.record.phase = None
+
+
+class _NoPhase:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_no_phase = _NoPhase()
+
+
+def phase(name: str = None):
+    return _Phase(_record, name) if _record is not None else _no_phase
+
+
+def _timed(name: str = None, func=None):
+    def timed(*args, **kwargs):
+        with phase(name):
+            return func(*args, **kwargs)
+
+    return timed
+
+
+def install() -> None:
+    # library calls every task goes through: redis round trips (commands & pipelines) and plex JSON decoding
+    redis.client.Redis.execute_command = _timed("redis", redis.client.Redis.execute_command)
+    redis.client.Pipeline.execute = _timed("redis", redis.client.Pipeline.execute)
+    requests.Response.json = _timed("json", requests.Response.json)
+
+
+class ProfiledJob(Job):
+    def perform(self):
+        record = _record
+        if record is None:
+            return super().perform()
+
+        # the job arguments are unpickled on first use, rq's share of the work
+        record.running = True
+        with _Phase(record, "rq"):
+            self.kwargs
+
+        started = time.perf_counter()
+        try:
+            return super().perform()
+        finally:
+            record.running = False
+            record.task_time = time.perf_counter() - started
+
+
+class _Sampler(threading.Thread):
+    # stacks of the worker thread every few ms, "frame;frame;... count" lines (flamegraph.pl, speedscope)
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.thread_id = threading.get_ident()
+        self.stacks = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(PROFILE_SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                stack = ";".join(reversed(stack))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def dump(self, path: str = None) -> None:
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+
+@contextlib.contextmanager
+def profile_job(job: Job = None):
+    # PoolWorker.execute_job runs every job inside it: phases always, a profiler for the chosen mode
+    global _record
+
+    if not PROFILING:
+        yield
+        return
+
+    _record = record = _Record()
+    profiler = None
+    if TASK_PROFILING == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif TASK_PROFILING == "sample":
+        profiler = _Sampler()
+        profiler.start()
+    started = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        total = time.perf_counter() - started
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+        elif profiler:
+            profiler.stop()
+        _record = None
+
+        # jobs put back in their queue (no free crawl slot) never ran
+        if record.task_time:
+            _save(job, record, total, profiler)
+
+
+def _save(job: Job = None, record: _Record = None, total: float = None, profiler=None) -> None:
+    task = job.func_name.removeprefix("tasks.")
+    phases = {
+        **record.phases,
+        # rq bookkeeping around the task: registries, heartbeats, result
+        "rq": record.phases.get("rq", 0) + total - record.task_time,
+        "other": max(record.task_time - sum(seconds for name, seconds in record.phases.items() if name != "rq"), 0),
+    }
+
+    metrics.inc("pr_task_jobs_total", task=task)
+    metrics.inc("pr_task_seconds_total", total, task=task)
+    for name, seconds in phases.items():
+        metrics.inc("pr_task_phase_seconds_total", seconds, task=task, phase=name)
+    for name, calls in record.calls.items():
+        metrics.inc("pr_task_phase_calls_total", calls, task=task, phase=name)
+
+    # the slowest jobs so far, with their profile when there's one
+    slowest = redis_connection.zrange("pr:profile:slowest", 0, 0, withscores=True)
+    if redis_connection.zcard("pr:profile:slowest") >= PROFILE_SLOWEST and slowest and total <= slowest[0][1]:
+        return
+
+    profile_file = None
+    if profiler is not None:
+        os.makedirs(PROFILE_PATH, exist_ok=True)
+        extension = "pstats" if isinstance(profiler, cProfile.Profile) else "folded"
+        profile_file = os.path.join(PROFILE_PATH, f"{task}-{job.id}.{extension}")
+        if isinstance(profiler, cProfile.Profile):
+            profiler.dump_stats(profile_file)
+        else:
+            profiler.dump(profile_file)
+
+    pipe = redis_connection.pipeline(transaction=True)
+    pipe.zadd("pr:profile:slowest", {job.id: total})
+    pipe.hset(
+        "pr:profile:jobs",
+        job.id,
+        json.dumps(
+            {
+                "task": task,
+                "seconds": round(total, 4),
+                "phases": {name: round(seconds, 4) for name, seconds in phases.items()},
+                "calls": record.calls,
+                "file": profile_file,
+                "at": int(time.time()),
+            }
+        ),
+    )
+    pipe.zrange("pr:profile:slowest", 0, -PROFILE_SLOWEST - 1)
+    pipe.zremrangebyrank("pr:profile:slowest", 0, -PROFILE_SLOWEST - 1)
+    dropped = pipe.execute()[2]
+
+    if dropped:
+        for dropped_job in redis_connection.hmget("pr:profile:jobs", dropped):
+            dropped_file = json.loads(dropped_job or "{}").get("file")
+            if dropped_file and os.path.exists(dropped_file):
+                os.remove(dropped_file)
+        redis_connection.hdel("pr:profile:jobs", *dropped)
@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+
+import redis
+from starlette.config import Config
+
+from .plex_reshare import DEVELOPMENT, end_stuck_crawl, r
+from .pool import crawl_queue, discovery_queue, enqueue_once, enqueue_scheduled_crawls, index_queue
+
+config = Config()
+REFRESH_SERVERS_INTERVAL = config("REFRESH_SERVERS_INTERVAL", cast=int, default=60) * 60
+REFRESH_LIBRARIES_INTERVAL = config("REFRESH_LIBRARIES_INTERVAL", cast=int, default=9 * 60) * 60
+REFRESH_JITTER = min(max(config("REFRESH_JITTER", cast=int, default=20), 0), 90) / 100
+SNAPSHOT_INTERVAL = config("SNAPSHOT_INTERVAL", cast=int, default=30) * 60
+PROBE_INTERVAL = config("PROBE_INTERVAL", cast=int, default=10) * 60
+SCHEDULER_TICK = 15
+SCHEDULER_LEASE = 4 * SCHEDULER_TICK
+RKEY_SCHEDULE = "pr:schedule"
+RKEY_LEADER = "pr:scheduler:leader"
+
+logger = logging.getLogger(__name__)
+
+# the leader keeps renewing its lease, everyone else only takes over once it ran out
+_renew_leadership = r.register_script(
+    """
+    if redis.call("GET", KEYS[1]) == ARGV[1] then
+        return redis.call("EXPIRE", KEYS[1], ARGV[2])
+    end
+    if redis.call("SET", KEYS[1], ARGV[1], "NX", "EX", ARGV[2]) then
+        return 1
+    end
+    return 0
+    """
+)
+
+
+def _jitter(interval: int = None) -> float:
+    return interval * random.uniform(1 - REFRESH_JITTER, 1 + REFRESH_JITTER)
+
+
+def run_due_refreshes() -> None:
+    # pr:schedule holds the next run of every refresh (servers discovery, libraries of each node, connection
+    # probes, snapshot) and when the show crawls still running are given up, it lives in redis so a new leader
+    # picks up where the previous one left
+    now = time.time()
+    r.zadd(RKEY_SCHEDULE, {"servers": now + random.randint(1, 20 if DEVELOPMENT else 60)}, nx=True)
+    if SNAPSHOT_INTERVAL:
+        r.zadd(RKEY_SCHEDULE, {"snapshot": now + SNAPSHOT_INTERVAL}, nx=True)
+    if PROBE_INTERVAL:
+        r.zadd(RKEY_SCHEDULE, {"probe": now + PROBE_INTERVAL}, nx=True)
+
+    due = r.zrangebyscore(RKEY_SCHEDULE, "-inf", now)
+    if not due:
+        return
+
+    plex_servers = {ps["node"]: ps for ps in json.loads(r.get("pr:servers") or "[]")}
+
+    for entry in due:
+        kind, _, node = entry.partition(":")
+
+        if kind == "servers":
+            enqueue_once(discovery_queue, "tasks.get_plex_servers", job_id="get_plex_servers")
+            r.zadd(RKEY_SCHEDULE, {entry: now + _jitter(REFRESH_SERVERS_INTERVAL)})
+        elif kind == "snapshot":
+            enqueue_once(index_queue, "tasks.save_snapshot", job_id="save_snapshot")
+            r.zadd(RKEY_SCHEDULE, {entry: now + SNAPSHOT_INTERVAL})
+        elif kind == "probe":
+            enqueue_once(discovery_queue, "tasks.probe_plex_servers", job_id="probe_plex_servers")
+            r.zadd(RKEY_SCHEDULE, {entry: now + PROBE_INTERVAL})
+        elif kind == "crawl":
+            # no crawl job of the library finished for CRAWL_TTL
+            node, _, library_key = node.partition(":")
+            if node in plex_servers:
+                end_stuck_crawl(plex_server=plex_servers[node], library_key=library_key)
+            r.zrem(RKEY_SCHEDULE, entry)
+        elif node in plex_servers:
+            enqueue_once(
+                crawl_queue(node),
+                "tasks.get_plex_libraries",
+                job_id=f"get_plex_libraries:{node}",
+                kwargs={"plex_server": plex_servers[node]},
+            )
+            r.zadd(RKEY_SCHEDULE, {entry: now + _jitter(REFRESH_LIBRARIES_INTERVAL)})
+        else:
+            # node is gone from the discovery
+            r.zrem(RKEY_SCHEDULE, entry)
+
+
+class RefreshScheduler(threading.Thread):
+    # runs next to every worker, only the replica holding the leader lease enqueues anything
+    def __init__(self):
+        super().__init__(name="refresh-scheduler", daemon=True)
+        self.identity = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def run(self):
+        while True:
+            try:
+                if _renew_leadership(keys=[RKEY_LEADER], args=[self.identity, SCHEDULER_LEASE]):
+                    run_due_refreshes()
+                    enqueue_scheduled_crawls()
+            except redis.RedisError as e:
+                logger.warning("refresh scheduler: %s", e)
+
+            time.sleep(SCHEDULER_TICK + random.uniform(0, 1))
@@ -0,0 +1,122 @@
+import os
+import sqlite3
+import time
+
+import redis
+from starlette.config import Config
+
+from .plex_reshare import r
+
+config = Config()
+SNAPSHOT_PATH = config("SNAPSHOT_PATH", cast=str, default="/pr/snapshot.db")
+SNAPSHOT_BATCH = 1000
+# worker state that means nothing after a restart
+SNAPSHOT_SKIP = (
+    "pr:g:",
+    "pr:ratelimit:",
+    "pr:slots:",
+    "pr:enqueue:",
+    "pr:scheduler:",
+    "pr:schedule",
+    "pr:snapshot:",
+    "pr:metrics",
+    "pr:crawl:",
+    "pr:rebuild:",
+    "pr:merge:",
+    "pr:profile:",
+)
+
+# DUMP/RESTORE payloads are binary, the shared connection decodes everything
+r_raw = redis.Redis(
+    host=config("REDIS_HOST", default="localhost"),
+    port=config("REDIS_PORT", cast=int, default=6379),
+    db=11,
+)
+
+
+def _get_snapshot_keys() -> list:
+    # current generation of every node index, plus node records, crawl data & sync states;
+    # older generations are on their way out and never saved
+    snapshot_keys = []
+
+    for key in r.scan_iter(match="pr:*", count=SNAPSHOT_BATCH):
+        if not key.startswith(SNAPSHOT_SKIP):
+            snapshot_keys.append(key)
+
+        if key.startswith("pr:gen:") and "/" in key:
+            gen = r.get(key)
+            if gen:
+                snapshot_keys.append(f"pr:g:{gen}:keys")
+                snapshot_keys.extend(r.smembers(f"pr:g:{gen}:keys"))
+
+    return snapshot_keys
+
+
+def save_snapshot() -> None:
+    # compact copy of the index in sqlite (redis DUMP payloads), written aside and swapped in at once
+    snapshot_keys = _get_snapshot_keys()
+    snapshot_tmp = f"{SNAPSHOT_PATH}.tmp"
+
+    if os.path.exists(snapshot_tmp):
+        os.remove(snapshot_tmp)
+
+    db = sqlite3.connect(snapshot_tmp)
+    db.execute("CREATE TABLE snapshot (key TEXT PRIMARY KEY, ttl INTEGER, value BLOB)")
+    db.execute("CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)")
+
+    for i in range(0, len(snapshot_keys), SNAPSHOT_BATCH):
+        batch = snapshot_keys[i : i + SNAPSHOT_BATCH]
+        pipe = r_raw.pipeline(transaction=False)
+        for key in batch:
+            pipe.pttl(key)
+            pipe.dump(key)
+        values = pipe.execute()
+
+        db.executemany(
+            "INSERT OR REPLACE INTO snapshot VALUES (?, ?, ?)",
+            [
+                (key, max(ttl, 0), value)
+                for key, ttl, value in zip(batch, values[::2], values[1::2])
+                # gone in the meantime
+                if value is not None
+            ],
+        )
+
+    db.execute("INSERT INTO meta VALUES (?, ?)", ("created_at", str(int(time.time()))))
+    db.commit()
+    db.close()
+
+    os.replace(snapshot_tmp, SNAPSHOT_PATH)
+
+
+def restore_snapshot() -> bool:
+    # warm start: an empty redis (fresh container, flushed db) gets the last snapshot back, the crawls that
+    # follow only reconcile it with the servers; an index that is already there is never overwritten
+    if not os.path.exists(SNAPSHOT_PATH) or r.exists("pr:gen"):
+        return False
+    if not r.set("pr:snapshot:restoring", str(os.getpid()), nx=True, ex=10 * 60):
+        return False
+
+    restored_keys = []
+
+    try:
+        db = sqlite3.connect(SNAPSHOT_PATH)
+        rows = db.execute("SELECT key, ttl, value FROM snapshot")
+
+        while batch := rows.fetchmany(SNAPSHOT_BATCH):
+            pipe = r_raw.pipeline(transaction=False)
+            for key, ttl, value in batch:
+                pipe.restore(key, ttl, value, replace=True)
+                restored_keys.append(key)
+            pipe.execute()
+
+        db.close()
+    except (sqlite3.Error, redis.ResponseError):
+        # corrupted snapshot or dumped by an incompatible redis, no half restored index
+        for i in range(0, len(restored_keys), SNAPSHOT_BATCH):
+            r.delete(*restored_keys[i : i + SNAPSHOT_BATCH])
+        return False
+    finally:
+        r.delete("pr:snapshot:restoring")
+
+    return True
@@ -1,5 +1,7 @@
+import functools
 import os
 import re
+import unicodedata
 
 import redis
 
@@ -9,6 +11,10 @@ redis_connection = redis.Redis(
     db=os.getenv("REDIS_DB_RQ", default=11),
 )
 
+_IDENTITY_TAGS = re.compile(r"\[[^\]]*\]|\{[^}]*\}")
+_IDENTITY_SEPARATORS = re.compile(r"[\W_]+")
+_SEASON_FOLDER = re.compile(r"^(season|saison|staffel|series|s)[\s._-]*\d+$|^specials$", flags=re.I)
+
 
 def get_common_paths(paths: list) -> list:
     common_paths = {}
@@ -31,23 +37,164 @@ def get_common_paths(paths: list) -> list:
     return common_paths
 
 
+@functools.lru_cache(maxsize=200_000)
+def cleanup_segment(segment: str = None) -> str:
+    # same folder names repeat for every file below them, clean each of them only once.
+    # plain string ops, same result as re.sub(r"(?:(.+)(\[.*\]))$", r"\1") + re.sub(r"^(\[.*?\])(.*)", r"\2")
+
+    # remove [xyz] ending
+    if segment.endswith("]"):
+        tag_start = segment.rfind("[", 1, len(segment) - 1)
+        if tag_start > 0:
+            segment = segment[:tag_start]
+    segment = segment.strip()
+
+    # remove starting [xyz]
+    if segment.startswith("["):
+        tag_end = segment.find("]", 1)
+        if tag_end > 0:
+            segment = segment[tag_end + 1 :]
+
+    return segment.strip()
+
+
 def cleanup_path(path: str = None) -> str:
     # remove paths with less than 3 chars
-    path_segments = list(filter(lambda x: len(x) > 2, path.split("/")))
+    return "/".join(cleanup_segment(p) for p in path.split("/") if len(p) > 2)
 
-    # clean paths a bit
-    path_segments = list(
-        map(
-            lambda p: re.sub(r"(?:(.+)(\[.*\]))$", r"\1", p).strip(),  # remove [xyz] ending
-            path_segments,
-        )
-    )
 
-    path_segments = list(
-        map(
-            lambda p: re.sub(r"^(\[.*?\])(.*)", r"\2", p).strip(),  # remove starting [xyz]
-            path_segments,
-        )
-    )
+def strip_common_paths(paths: list, base_paths: list) -> list:
+    # prefix trie of the common base paths, every path gets the deepest matching base removed in one walk
+    trie = {}
+    for base_path in base_paths:
+        trie_node = trie
+        for segment in base_path.split("/"):
+            trie_node = trie_node.setdefault(segment, {})
+        trie_node[None] = True
+
+    stripped_paths = []
+    for path in paths:
+        path_segments = path.split("/")
+        trie_node, cut = trie, 0
+
+        # the last segment is the file itself, never a base path
+        for depth, segment in enumerate(path_segments[:-1]):
+            trie_node = trie_node.get(segment)
+            if trie_node is None:
+                break
+            if None in trie_node:
+                cut = depth + 1
+
+        stripped_paths.append("/".join(path_segments[cut:]).lstrip("/"))
+
+    return stripped_paths
+
+
+def get_dir_children(paths: list) -> dict:
+    # map every parent folder to its direct children, folders end with "/"
+    dir_children = {}
+
+    for path in paths:
+        path_chunks = path.strip("/").split("/")
+
+        for depth in range(len(path_chunks)):
+            parent = "/".join(path_chunks[:depth])
+            child = path_chunks[depth] + ("/" if depth < len(path_chunks) - 1 else "")
+            dir_children.setdefault(parent, set()).add(child)
+
+    return dir_children
+
+
+def get_sort_key(name: str) -> str:
+    # listing order of a folder's children, the app compares page cursors the same way
+    return name.rstrip("/").lower()
 
-    return "/".join(path_segments)
+
+def get_dir_stats(files: dict) -> dict:
+    # {"folder/sub/file": (size, mtime)} -> {"folder/": (total size, newest mtime), "folder/sub/": ...}
+    dir_stats = {}
+
+    for path, (size, mtime) in files.items():
+        path_chunks = path.split("/")[:-1]
+
+        for depth in range(1, len(path_chunks) + 1):
+            dir_path = "/".join(path_chunks[:depth]) + "/"
+            dir_size, dir_mtime = dir_stats.get(dir_path, (0, 0))
+            dir_stats[dir_path] = (dir_size + size, max(dir_mtime, mtime))
+
+    return dir_stats
+
+
+def get_media_identity(path: str = None, size: int = None) -> str:
+    # same release on several servers: same file name (title, year, episode, quality...) once case, separators
+    # and [tags] {tags} are left aside, and the exact same size; folders are laid out differently everywhere
+    name = os.path.splitext(path.rsplit("/", 1)[-1])[0]
+    name = _IDENTITY_SEPARATORS.sub(" ", _IDENTITY_TAGS.sub(" ", name.lower())).strip()
+    return f"{name}\t{size}"
+
+
+def normalize_title(title: str = None) -> str:
+    # lowercase words without accents & punctuation, titles are indexed and looked up that way (see app/main.py)
+    title = unicodedata.normalize("NFKD", title.lower())
+    title = "".join(c for c in title if not unicodedata.combining(c))
+    return " ".join(_IDENTITY_SEPARATORS.sub(" ", title).split())
+
+
+def get_trigrams(title: str = None) -> set:
+    # of a normalized title, padded so word starts & ends weigh in
+    title = f" {title} "
+    return {title[i : i + 3] for i in range(len(title) - 2)}
+
+
+def get_search_entries(media_paths: list, titles: dict = None) -> dict:
+    # what search finds: the folder of every movie / show, named after its "title (year)" when the crawl
+    # knows it; season folders & files below it aren't entries of their own
+    # ["Show/Season 01/e1.mkv", ...] -> {"Show": "Show"}
+    entries = {}
+
+    for media_path in media_paths:
+        path_chunks = media_path.split("/")[:-1]
+        for depth, path_chunk in enumerate(path_chunks):
+            if _SEASON_FOLDER.match(path_chunk):
+                path_chunks = path_chunks[:depth]
+                break
+
+        entry = "/".join(path_chunks)
+        if entry and entry not in entries:
+            entries[entry] = (titles or {}).get(media_path) or path_chunks[-1]
+
+    return entries
+
+
+class MediaFilter:
+    # crawl-time filters built once: sets for extensions & resolutions and one regex for all the templates
+    def __init__(
+        self,
+        extensions: list = None,
+        resolutions: list = None,
+        templates: list = None,
+        min_size: int = 0,
+    ):
+        self.extensions = frozenset(extensions or [])
+        self.resolutions = frozenset(resolutions or [])
+        self.min_size = min_size
+        self.templates = None
+
+        if templates:
+            try:
+                self.templates = [re.compile("|".join(f"(?:{t})" for t in templates), flags=re.I)]
+            except re.error:
+                # templates with global inline flags can't be combined
+                self.templates = [re.compile(t, flags=re.I) for t in templates]
+
+    def skip_media(self, media: dict = None) -> bool:
+        return media.get("videoResolution") in self.resolutions
+
+    def skip_part(self, part: dict = None, name: str = None) -> bool:
+        return (
+            not part.get("key")
+            or not part.get("file")
+            or part.get("container") in self.extensions
+            or part.get("size", 1) / 1000000 < self.min_size
+            or (self.templates is not None and any(t.match(name) for t in self.templates))
+        )
@@ -1,10 +1,60 @@
+import logging
+import multiprocessing
+import time
+from multiprocessing.connection import wait
+
+from tasks.pool import RQ_WORKERS, PoolWorker
+from tasks.profiling import PROFILING, ProfiledJob, install as install_profiling
+from tasks.scheduler import RefreshScheduler
+from tasks.snapshot import restore_snapshot
 from tasks.utilities import redis_connection
 
-from rq import Connection, Queue, Worker
+from rq import Connection
+from rq.job import Job
+
+WORKER_RESTART_DELAY = 5
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker() -> None:
+    # TASK_PROFILING: where the time of every job goes (see tasks/profiling.py)
+    if PROFILING:
+        install_profiling()
 
-if __name__ == "__main__":
     with Connection(redis_connection):
-        worker = Worker(
-            list(map(Queue, ["default"])), default_result_ttl=120, maintenance_interval=600, default_worker_ttl=300
+        # jobs run in-process so the keep-alive sessions to the plex nodes survive between jobs
+        worker = PoolWorker(
+            default_result_ttl=120,
+            maintenance_interval=600,
+            default_worker_ttl=300,
+            job_class=ProfiledJob if PROFILING else Job,
         )
         worker.work(with_scheduler=True)
+
+
+def start_worker(i: int = None) -> multiprocessing.Process:
+    worker = multiprocessing.Process(target=run_worker, name=f"rq-worker-{i}")
+    worker.start()
+    return worker
+
+
+if __name__ == "__main__":
+    # warm start from the last snapshot when redis comes up empty, the scheduled crawls then reconcile it
+    restore_snapshot()
+
+    workers = [start_worker(i) for i in range(RQ_WORKERS)]
+
+    # periodic servers/libraries refreshes, only one replica at a time is actually scheduling
+    RefreshScheduler().start()
+
+    # a worker that's gone (crashed, killed for memory...) is replaced on its own, the others carry on with
+    # their jobs; supervisord stops the whole process group
+    while True:
+        wait([worker.sentinel for worker in workers])
+        for i, worker in enumerate(workers):
+            if not worker.is_alive():
+                worker.join()
+                logger.warning("%s exited with code %s, restarting it", worker.name, worker.exitcode)
+                time.sleep(WORKER_RESTART_DELAY)
+                workers[i] = start_worker(i)
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import fakeredis
+import pytest
+import redis
+
+# the tasks package lives in rq/, next to the worker
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rq"))
+
+# every redis client (tasks, rq queues) talks to the same in-memory server
+_server = fakeredis.FakeServer()
+redis.Redis = lambda *args, **kwargs: fakeredis.FakeRedis(
+    server=_server, db=kwargs.get("db", 0), decode_responses=kwargs.get("decode_responses", False)
+)
+
+
+@pytest.fixture(autouse=True)
+def flush_redis():
+    yield
+    fakeredis.FakeRedis(server=_server).flushall()
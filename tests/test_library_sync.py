@@ -0,0 +1,74 @@
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+
+import tasks.plex_reshare as plex_reshare
+from tasks.pool import crawl_queue
+
+PLEX_SERVER = {"node": "node1", "uri": "node1.plex.direct:32400", "token": "token"}
+
+
+class FakeResponse:
+    def __init__(self, data: dict = None):
+        self.data = data
+
+    def json(self) -> dict:
+        return self.data
+
+
+def queued_jobs() -> list:
+    return [(job.func_name, job.kwargs["library"]["key"]) for job in crawl_queue(PLEX_SERVER["node"]).jobs]
+
+
+@pytest.fixture
+def plex(monkeypatch):
+    # /library/sections lists a movie and a show library, the flat episodes count answers with `episodes`
+    answers = {"episodes": requests.ConnectionError("flat listing refused")}
+
+    def plex_get(node: str = None, url: str = None, **kwargs) -> FakeResponse:
+        url = urlparse(url)
+        if url.path == "/library/sections":
+            return FakeResponse({"MediaContainer": {"Directory": [{"key": "1", "type": "movie"}, {"key": "2", "type": "show"}]}})
+        if parse_qs(url.query).get("type") == ["4"]:
+            if isinstance(answers["episodes"], Exception):
+                raise answers["episodes"]
+            return FakeResponse(answers["episodes"])
+        return FakeResponse({"MediaContainer": {"offset": 0, "size": 0, "totalSize": 0}})
+
+    monkeypatch.setattr(plex_reshare, "plex_get", plex_get)
+    return answers
+
+
+@pytest.mark.parametrize(
+    "episodes",
+    [requests.ConnectionError("flat listing refused"), ValueError("not json"), {"MediaContainer": {"size": 0}}],
+)
+def test_flat_count_failure_falls_back_to_shows_crawl(plex, episodes):
+    plex["episodes"] = episodes
+
+    plex_reshare.get_plex_libraries(plex_server=PLEX_SERVER)
+
+    # the movies are still crawled, the show library goes the show -> season -> episode way
+    assert plex_reshare.r.exists("pr:node:node1:noflat")
+    assert queued_jobs() == [("tasks.get_plex_library", "1"), ("tasks.get_plex_library", "2")]
+    assert plex_reshare.r.hget("pr:sync:node1:1", "target") == "pr:movies:node1:1"
+    assert not plex_reshare.r.exists("pr:sync:node1:2")
+
+
+@pytest.mark.parametrize(
+    "task, library",
+    [
+        (plex_reshare.get_plex_library, {"key": "1", "type": "movie"}),
+        (plex_reshare.get_plex_library_episodes, {"key": "2", "type": "show"}),
+    ],
+)
+def test_page_without_sync_state_restarts_sync(plex, task, library):
+    plex["episodes"] = {"MediaContainer": {"offset": 0, "size": 0, "totalSize": 0, "Metadata": []}}
+
+    # pr:sync:<node>:<library> expired while the crawl was queued
+    task(plex_server=PLEX_SERVER, library=library, offset=300)
+
+    media_type = "movies" if library["type"] == "movie" else "shows"
+    assert plex_reshare.r.hget(f"pr:sync:node1:{library['key']}", "target") == f"pr:{media_type}:node1:{library['key']}"
+    assert [job.kwargs["offset"] for job in crawl_queue(PLEX_SERVER["node"]).jobs] == [0]
@@ -0,0 +1,47 @@
+from tasks.merge import merge_media
+from tasks.plex_reshare import MERGED_NODE, _publish_generation, r
+
+
+def publish(node, medias):
+    _publish_generation(
+        plex_server={"node": node},
+        media_type="movies",
+        medias={path: f"/library/parts/{size}/file.mkv" for path, size in medias.items()},
+        medias_stats={path: (size, 0) for path, size in medias.items()},
+    )
+
+
+def merged_files():
+    gen = r.get(f"pr:gen:movies/{MERGED_NODE}")
+    return r.hgetall(f"pr:g:{gen}:files:movies/{MERGED_NODE}")
+
+
+def test_shared_release_listed_once():
+    publish("node1", {"Movie (2000)/Movie (2000).mkv": 100})
+    publish("node2", {"Films/Movie.2000.mkv": 100})
+    r.set("pr:merge:movies", 1)
+
+    merge_media(media_type="movies")
+
+    assert merged_files() == {
+        "Movie (2000)/Movie (2000).mkv": "node1\t/library/parts/100/file.mkv\nnode2\t/library/parts/100/file.mkv"
+    }
+
+
+def test_releases_under_the_same_name_never_overwrite_each_other():
+    # same name, different sizes, nodes sharing their first 8 characters
+    path = "Movie (2000)/Movie (2000).mkv"
+    for i in range(1, 5):
+        publish(f"abcdefgh{i}", {path: i})
+    publish("other", {"Movie (2000)/Movie (2000) [abcdefgh].mkv": 5})
+    r.set("pr:merge:movies", 1)
+
+    merge_media(media_type="movies")
+
+    assert merged_files() == {
+        path: "abcdefgh1\t/library/parts/1/file.mkv",
+        "Movie (2000)/Movie (2000) [abcdefgh].mkv": "abcdefgh2\t/library/parts/2/file.mkv",
+        "Movie (2000)/Movie (2000) [abcdefgh3].mkv": "abcdefgh3\t/library/parts/3/file.mkv",
+        "Movie (2000)/Movie (2000) [abcdefgh4].mkv": "abcdefgh4\t/library/parts/4/file.mkv",
+        "Movie (2000)/Movie (2000) [abcdefgh] [other].mkv": "other\t/library/parts/5/file.mkv",
+    }
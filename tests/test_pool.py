@@ -0,0 +1,86 @@
+import threading
+import time
+
+import rq
+from rq.suspension import suspend
+
+from tasks import pool
+from tasks.utilities import redis_connection
+
+
+def run_concurrently(target, count: int = None) -> None:
+    barrier = threading.Barrier(count)
+
+    def run() -> None:
+        barrier.wait()
+        target()
+
+    threads = [threading.Thread(target=run) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_enqueue_once_concurrent_callers():
+    # interim rebuild requests of several workers at once queue a single job
+    run_concurrently(
+        lambda: pool.enqueue_once(pool.index_queue, "tasks.process_media", job_id="process_media:shows:node1"),
+        count=8,
+    )
+
+    assert pool.index_queue.get_job_ids() == ["process_media:shows:node1"]
+    assert not redis_connection.exists("pr:enqueue:process_media:shows:node1")
+
+    # still queued, asked again later
+    pool.enqueue_once(pool.index_queue, "tasks.process_media", job_id="process_media:shows:node1")
+    assert pool.index_queue.get_job_ids() == ["process_media:shows:node1"]
+
+
+def test_slot_lease_covers_the_job_timeout():
+    worker = pool.PoolWorker(connection=redis_connection)
+    queue = pool.crawl_queue("node1")
+
+    for timeout, lease in [(None, 180), (600, 600), (-1, pool.CRAWL_SLOT_LEASE_MAX)]:
+        job = queue.enqueue("tasks.get_seasons", job_timeout=timeout)
+        assert worker._get_slot_lease(job) == lease + pool.SLOT_LEASE_MARGIN
+
+
+def test_dequeue_waits_while_suspended(monkeypatch):
+    monkeypatch.setattr(pool, "POOL_POLL_INTERVAL", 1)
+    worker = pool.PoolWorker(connection=redis_connection)
+
+    # `rq suspend` while the worker is waiting for jobs: once the round is over, what's queued stays queued
+    def suspend_then_stop() -> None:
+        time.sleep(0.5)
+        suspend(redis_connection)
+        time.sleep(1)
+        pool.index_queue.enqueue("tasks.process_media", job_id="process_media:shows:node1")
+        time.sleep(1)
+        worker._stop_requested = True
+
+    threading.Thread(target=suspend_then_stop).start()
+
+    assert worker.dequeue_job_and_maintain_ttl(timeout=405) is None
+    assert pool.index_queue.get_job_ids() == ["process_media:shows:node1"]
+
+
+def test_dequeue_picks_up_new_crawl_queues(monkeypatch):
+    monkeypatch.setattr(pool, "POOL_POLL_INTERVAL", 1)
+    worker = pool.PoolWorker(connection=redis_connection)
+
+    def enqueue() -> None:
+        time.sleep(1.5)
+        pool.crawl_queue("node1").enqueue("tasks.get_seasons", job_id="get_seasons:node1:/library/metadata/1")
+
+    threading.Thread(target=enqueue).start()
+    job, queue = worker.dequeue_job_and_maintain_ttl(timeout=405)
+
+    assert (job.id, queue.name) == ("get_seasons:node1:/library/metadata/1", "crawl:node1")
+
+
+def test_burst_dequeue_returns_when_idle():
+    worker = pool.PoolWorker(connection=redis_connection)
+
+    assert worker.dequeue_job_and_maintain_ttl(timeout=None) is None
+    assert isinstance(worker, rq.SimpleWorker)
@@ -0,0 +1,124 @@
+import json
+import time
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+
+import rq
+import tasks.plex_reshare as plex_reshare
+from tasks.pool import crawl_queue
+from tasks.scheduler import run_due_refreshes
+
+PLEX_SERVER = {"node": "node1", "uri": "node1.plex.direct:32400", "token": "token"}
+LIBRARY = {"key": "2", "type": "show"}
+SHOWS = 3
+SEASONS = 2
+EPISODES = 150
+
+
+class FakeResponse:
+    def __init__(self, data: dict = None):
+        self.data = data
+
+    def json(self) -> dict:
+        return {"MediaContainer": self.data}
+
+
+@pytest.fixture
+def plex(monkeypatch):
+    # library -> 3 shows -> 2 seasons -> 150 episodes (2 pages), `failures` lists the urls to fail and how often
+    failures = {}
+
+    def plex_get(node: str = None, url: str = None, **kwargs) -> FakeResponse:
+        url = urlparse(url)
+        if failures.get(url.path):
+            failures[url.path] -= 1
+            raise requests.ConnectionError(f"{url.path} failed")
+
+        offset = int(parse_qs(url.query)["X-Plex-Container-Start"][0])
+        if url.path == "/library/sections/2/all":
+            shows = [{"key": f"/library/metadata/{show}/children"} for show in range(SHOWS)]
+            return FakeResponse({"offset": 0, "size": SHOWS, "totalSize": SHOWS, "Metadata": shows})
+
+        show = url.path.split("/")[3]
+        if len(show) == 1:
+            seasons = [{"key": f"/library/metadata/{show}{season}/children"} for season in range(SEASONS)]
+            return FakeResponse({"offset": 0, "size": SEASONS, "totalSize": SEASONS, "Metadata": seasons})
+
+        episodes = []
+        for episode in range(offset, min(offset + 100, EPISODES)):
+            part = {"key": f"/library/parts/{show}{episode}/file.mkv", "file": f"/tv/{show}/{episode}.mkv"}
+            part.update({"size": 500_000_000, "container": "mkv"})
+            episodes.append({"Media": [{"videoResolution": "1080", "Part": [part]}]})
+        return FakeResponse({"offset": offset, "size": len(episodes), "totalSize": EPISODES, "Metadata": episodes})
+
+    monkeypatch.setattr(plex_reshare, "plex_get", plex_get)
+    return failures
+
+
+@pytest.fixture
+def rebuilds(monkeypatch):
+    # the final flag of every index rebuild request, with the episodes stored at that time
+    requests_made = []
+
+    def request_process_media(plex_server: dict = None, media_type: str = None, final: bool = False) -> None:
+        requests_made.append((final, plex_reshare.r.hlen(f"pr:shows:node1:{LIBRARY['key']}")))
+
+    monkeypatch.setattr(plex_reshare, "_request_process_media", request_process_media)
+    return requests_made
+
+
+def crawl() -> None:
+    plex_reshare._start_shows_crawl(plex_server=PLEX_SERVER, library=LIBRARY)
+    queue = crawl_queue(PLEX_SERVER["node"])
+    rq.SimpleWorker([queue], connection=queue.connection).work(burst=True)
+
+
+def test_crawl_ends_with_one_final_rebuild(plex, rebuilds):
+    crawl()
+
+    assert [final for final, _ in rebuilds].count(True) == 1
+    assert rebuilds[-1] == (True, SHOWS * SEASONS * EPISODES)
+    assert not plex_reshare.r.exists("pr:crawl:node1:2")
+    assert plex_reshare.r.zscore("pr:schedule", "crawl:node1:2") is None
+
+
+def test_retried_job_counts_once(plex, rebuilds, monkeypatch):
+    monkeypatch.setattr(plex_reshare, "rq_retries", rq.Retry(max=1))
+    plex["/library/metadata/1/children"] = 1
+    plex["/library/metadata/21/children"] = 1
+
+    crawl()
+
+    # the final rebuild waits for the retried jobs and what they queued
+    assert [final for final, _ in rebuilds].count(True) == 1
+    assert rebuilds[-1] == (True, SHOWS * SEASONS * EPISODES)
+
+
+def test_failed_job_still_ends_the_crawl(plex, rebuilds, monkeypatch):
+    monkeypatch.setattr(plex_reshare, "rq_retries", None)
+    plex["/library/metadata/10/children"] = 1
+
+    crawl()
+
+    # one season is missing from the index, the rest of the library is rebuilt once the crawl is over
+    assert [final for final, _ in rebuilds].count(True) == 1
+    assert rebuilds[-1] == (True, (SHOWS * SEASONS - 1) * EPISODES)
+    assert not plex_reshare.r.exists("pr:crawl:node1:2")
+
+
+def test_stuck_crawl_is_rebuilt_when_it_expires(plex, rebuilds):
+    plex_reshare.r.set("pr:servers", json.dumps([PLEX_SERVER]))
+    plex_reshare._start_shows_crawl(plex_server=PLEX_SERVER, library=LIBRARY)
+
+    # the worker running the first page died, the crawl never moves on
+    run_due_refreshes()
+    assert rebuilds == []
+
+    plex_reshare.r.zadd("pr:schedule", {"crawl:node1:2": time.time() - 1})
+    run_due_refreshes()
+
+    assert rebuilds == [(True, 0)]
+    assert not plex_reshare.r.exists("pr:crawl:node1:2")
+    assert plex_reshare.r.zscore("pr:schedule", "crawl:node1:2") is None
@@ -0,0 +1,121 @@
+import threading
+
+import tasks.plex_reshare as plex_reshare
+from tasks.utilities import cleanup_path
+
+PAGES = 16
+PAGE_SIZE = 100
+
+
+def movies_page(page: int = None) -> dict:
+    # a /library/sections/x/all page as plex returns it, one part per movie
+    metadata = []
+    for i in range(page * PAGE_SIZE, (page + 1) * PAGE_SIZE):
+        metadata.append(
+            {
+                "title": f"Movie {i}",
+                "year": 2000 + i % 20,
+                "updatedAt": 1_700_000_000 + i,
+                "Media": [
+                    {
+                        "videoResolution": "1080",
+                        "Part": [
+                            {
+                                "key": f"/library/parts/{i}/1600000000/file.mkv",
+                                "file": f"/data/movies/Movie {i} [1080p]/Movie {i}.mkv",
+                                "size": 2_000_000_000,
+                                "container": "mkv",
+                            }
+                        ],
+                    }
+                ],
+            }
+        )
+    return {"offset": page * PAGE_SIZE, "size": PAGE_SIZE, "totalSize": PAGES * PAGE_SIZE, "Metadata": metadata}
+
+
+def episodes_page(page: int = None) -> dict:
+    metadata = []
+    for i in range(page * PAGE_SIZE, (page + 1) * PAGE_SIZE):
+        metadata.append(
+            {
+                "addedAt": 1_600_000_000 + i,
+                "Media": [
+                    {
+                        "videoResolution": "1080",
+                        "Part": [
+                            {
+                                "key": f"/library/parts/{i}/1600000000/file.mkv",
+                                "file": f"/data/shows/Show {i // 10}/Season 01/Show {i // 10} - S01E{i % 10:02}.mkv",
+                                "size": 500_000_000,
+                                "container": "mkv",
+                            }
+                        ],
+                    }
+                ]
+            }
+        )
+    return {"offset": page * PAGE_SIZE, "size": PAGE_SIZE, "totalSize": PAGES * PAGE_SIZE, "Metadata": metadata}
+
+
+def run_concurrently(target, pages: list = None) -> None:
+    # every page of a library written into the same node hash by a different worker at once
+    barrier = threading.Barrier(len(pages))
+
+    def run(page: dict = None) -> None:
+        barrier.wait()
+        target(page)
+
+    threads = [threading.Thread(target=run, kwargs={"page": page}) for page in pages]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_get_movies_concurrent_pages():
+    plex_server = {"node": "node1"}
+    rkey_medias = "pr:movies:node1:1"
+    pages = [movies_page(page) for page in range(PAGES)]
+
+    run_concurrently(
+        lambda page: plex_reshare.get_movies(media_container=page, plex_server=plex_server, rkey_medias=rkey_medias),
+        pages,
+    )
+
+    # part key -> "cleaned path###movie folder placeholder\tsize\tmtime"
+    expected = {}
+    for page in pages:
+        for movie in page["Metadata"]:
+            part = movie["Media"][0]["Part"][0]
+            expected[part["key"]] = (
+                f"{cleanup_path(part['file'])}###{movie['title']} ({movie['year']})"
+                f"\t{part['size']}\t{movie['updatedAt']}"
+            )
+
+    assert plex_reshare.r.hgetall(rkey_medias) == expected
+    assert expected["/library/parts/0/1600000000/file.mkv"] == (
+        "data/movies/Movie 0/Movie 0.mkv###Movie 0 (2000)\t2000000000\t1700000000"
+    )
+    assert 0 < plex_reshare.r.ttl(rkey_medias) <= plex_reshare.SYNC_TTL
+
+
+def test_store_episodes_concurrent_pages():
+    rkey_medias = "pr:shows:node1:2"
+    pages = [episodes_page(page) for page in range(PAGES)]
+
+    run_concurrently(
+        lambda page: plex_reshare._store_episodes(media_container=page, rkey_medias=rkey_medias, rkey_ttl=3600),
+        pages,
+    )
+
+    # part key -> "cleaned path\tsize\tmtime", added date when plex has no updated one
+    expected = {}
+    for page in pages:
+        for episode in page["Metadata"]:
+            part = episode["Media"][0]["Part"][0]
+            expected[part["key"]] = f"{cleanup_path(part['file'])}\t{part['size']}\t{episode['addedAt']}"
+
+    assert plex_reshare.r.hgetall(rkey_medias) == expected
+    assert len(expected) == PAGES * PAGE_SIZE
+    assert 0 < plex_reshare.r.ttl(rkey_medias) <= 3600
@@ -0,0 +1,65 @@
+import re
+
+import pytest
+
+from tasks.utilities import cleanup_path, cleanup_segment, strip_common_paths
+
+
+@pytest.mark.parametrize(
+    "segment",
+    [
+        "Movie (2019) [1080p]",
+        "[grp] Show (2010) [tvdb-1]",
+        "[a][b] Show [c][d]",
+        "Show.S01E01.(x264)+[AAC]",
+        "[unclosed Show",
+        "Show ]closed[",
+        "[]",
+        "a[]",
+    ],
+)
+def test_cleanup_segment_matches_regex(segment):
+    # same output as the two re.sub cleanup_path ran per segment
+    expected = re.sub(r"(?:(.+)(\[.*\]))$", r"\1", segment).strip()
+    expected = re.sub(r"^(\[.*?\])(.*)", r"\2", expected).strip()
+
+    assert cleanup_segment(segment) == expected
+
+
+def test_cleanup_path():
+    assert cleanup_path("/data/[grp] Show [tvdb-1]/Season 01/ep.mkv") == "data/Show/Season 01/ep.mkv"
+
+
+def test_strip_common_paths_literal_base_paths():
+    # base paths are folder names, not patterns: "(", "+", "." only match themselves
+    paths = [
+        "media/Films (HD)/Movie/Movie.mkv",
+        "media/C++ Talks/Talk/Talk.mkv",
+        "Movies.HD/A/A.mkv",
+        "MoviesxHD/B/B.mkv",
+    ]
+    base_paths = ["media/Films (HD)", "media/C++ Talks", "Movies.HD"]
+
+    assert strip_common_paths(paths, base_paths) == [
+        "Movie/Movie.mkv",
+        "Talk/Talk.mkv",
+        "A/A.mkv",
+        "MoviesxHD/B/B.mkv",
+    ]
+
+
+def test_strip_common_paths_leading_whole_segments_once():
+    # only the deepest base path at the start of the path is removed, whole segments only
+    paths = ["media/media/Movie/Movie.mkv", "data/Show/data/ep.mkv", "mytv/Show/ep.mkv", "tv/Show/ep.mkv"]
+    base_paths = ["media", "data", "tv"]
+
+    assert strip_common_paths(paths, base_paths) == [
+        "media/Movie/Movie.mkv",
+        "Show/data/ep.mkv",
+        "mytv/Show/ep.mkv",
+        "Show/ep.mkv",
+    ]
+
+
+def test_strip_common_paths_keeps_file_name():
+    assert strip_common_paths(["media/media"], ["media"]) == ["media"]